@@ -191,8 +191,11 @@ class BarrelStack(cdk.Stack):
             ],
         )
 
+        # jobs are described to release held jobs and to resubmit those out of memory
         grant_list_jobs = iam.PolicyStatement(
-            effect=iam.Effect.ALLOW, actions=["batch:ListJobs"], resources=["*"]
+            effect=iam.Effect.ALLOW,
+            actions=["batch:ListJobs", "batch:DescribeJobs"],
+            resources=["*"],
         )
 
         worker.container.job_role.add_to_principal_policy(grant_submit_job)
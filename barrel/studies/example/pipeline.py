@@ -3,7 +3,8 @@ import worker
 
 from pathlib import Path
 
-from bioinformatics.data import Read, Sample
+from bioinformatics.counts import count_genes
+from bioinformatics.data import Sample, download_reads
 from bioinformatics.genome import Genome, Species
 from bioinformatics.software import FASTQC, STAR, PORT, SAMTOOLS, SAM2COV
 
@@ -15,20 +16,31 @@ analysis_directory = Path(
 
 worker.logs_directory = analysis_directory / "logs"
 
-# Software
+# Record the jobs and submit them together at the end
 
-software_directory = analysis_directory / "software"
+worker.graph = worker.Graph()
 
-fastqc = FASTQC("0.12.1", software_directory / "FastQC-0.12.1")
-star = STAR("2.7.10b", software_directory / "STAR-2.7.10b")
-port = PORT("0.8.5f-beta_hotfix1", software_directory / "PORT-v0.8.5f-beta_hotfix1")
-samtools = SAMTOOLS("1.18", software_directory / "samtools-1.18")
-sam2cov = SAM2COV("0.0.5.4-beta", software_directory / "sam2cov-v0.0.5.4-beta")
+# Skip steps whose command, tool version and inputs are unchanged since they last succeeded
+
+# worker.cache = worker.Cache(analysis_directory / "cache")
+
+# Software, installed once in the store shared with other analyses
+
+fastqc = FASTQC("0.12.1")
+samtools = SAMTOOLS("1.18")
+star = STAR("2.7.10b", samtools=samtools)
+port = PORT("0.8.5f-beta_hotfix1")
+sam2cov = SAM2COV("0.0.5.4-beta")
 
 # Genome
 
+# Without a location, the genome and its index are shared with other analyses
+
 genome = Genome(
-    Species.MUS_MUSCULUS, "GRCm38", release="102", location=analysis_directory / "genome"
+    Species.MUS_MUSCULUS,
+    "GRCm38",
+    release="102",
+    # location=analysis_directory / "genome",
 )
 
 star.create_index(genome)
@@ -48,31 +60,53 @@ treatments = {f"K{i+1}": f"Treatment{i+1}" for i in range(6)}
 
 sample_information = controls | treatments
 
-samples = []
+reads = download_reads(
+    [
+        (
+            f"{fastq_files_source_directory}/{sample_id}_{end}.fastq.gz",
+            analysis_directory / "fastq" / f"{sample_name}_{end}.fastq.gz",
+        )
+        for sample_id, sample_name in sample_information.items()
+        for end in (1, 2)
+    ]
+)
+
+fastqc.analyze_grouped(reads, analysis_directory / "qc")
+
+samples = [
+    Sample(id=sample_name, reads=reads[2 * i : 2 * i + 2])
+    for i, sample_name in enumerate(sample_information.values())
+]
 
-for sample_id, sample_name in sample_information.items():
-    forward_read = Read(
-        source=f"{fastq_files_source_directory}/{sample_id}_1.fastq.gz",
-        location=analysis_directory / "fastq" / f"{sample_name}_1.fastq.gz",
-    )
+# Align, compressing the alignments to BAM as they are written (or to CRAM with .cram)
 
-    reverse_read = Read(
-        source=f"{fastq_files_source_directory}/{sample_id}_2.fastq.gz",
-        location=analysis_directory / "fastq" / f"{sample_name}_2.fastq.gz",
-    )
+star.align_all(
+    samples,
+    [
+        analysis_directory / "alignment" / f"{sample.id}_Aligned.out.bam"
+        for sample in samples
+    ],
+)
 
-    fastqc.analyze(forward_read, analysis_directory / "qc")
-    fastqc.analyze(reverse_read, analysis_directory / "qc")
+# A deep sample can instead be split into chunks that are aligned in parallel
 
-    sample = Sample(id=sample_name, reads=[forward_read, reverse_read])
-    samples.append(sample)
+# star.align_scattered(samples[0], analysis_directory / "alignment" / "Control1_Aligned.out.sam")
 
-# Align
+# Alternatively, align a few samples per job against an index loaded into memory once
+
+# star.align_grouped(
+#     samples,
+#     [
+#         analysis_directory / "alignment" / f"{sample.id}_Aligned.out.bam"
+#         for sample in samples
+#     ],
+#     samples_per_job=4,
+#     concurrent=2,
+# )
 
-for sample in samples:
-    star.align(
-        sample, analysis_directory / "alignment" / f"{sample.id}_Aligned.out.sam"
-    )
+# Count the reads of every gene
+
+count_genes(samples, genome, analysis_directory / "counts", samtools=samtools)
 
 # Normalize
 
@@ -85,4 +119,13 @@ port.normalize(
     # second_part=True,
     # cutoff=3,
     # resume=True
+    # lsf_mode="local",
+    # vcpu=64,
+    # memory=262144,
 )
+
+# Submit
+
+graph = worker.graph
+graph.export(worker.logs_directory / "graph.dot")
+graph.run()
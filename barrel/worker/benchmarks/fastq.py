@@ -0,0 +1,99 @@
+"Measure how many reads per second the FASTQ statistics handle, against a record-by-record loop"
+
+import argparse
+import collections
+import gzip
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+os.environ.setdefault("FILE_SYSTEM_MOUNT_POINT", tempfile.mkdtemp())
+os.environ.setdefault("STUDY_NAME", "benchmark")
+os.environ.setdefault("ANALYSIS_NAME", "fastq")
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from bioinformatics.fastq import Statistics
+from transfer import READ_SIZE, GzipDecompressor
+
+
+def synthetic(reads: int, length: int) -> bytes:
+    "Gzip FASTQ of random reads, a tenth of them duplicated"
+
+    random = np.random.default_rng(42)
+    sequences = np.frombuffer(b"ACGT", dtype=np.uint8)[
+        random.integers(0, 4, (reads, length))
+    ]
+    sequences[::10] = sequences[1::10][: len(sequences[::10])]
+    qualities = random.integers(35, 74, (reads, length), dtype=np.uint8)
+
+    records = b"".join(
+        b"@read%d\n%s\n+\n%s\n" % (index, sequence.tobytes(), quality.tobytes())
+        for index, (sequence, quality) in enumerate(zip(sequences, qualities))
+    )
+
+    return gzip.compress(records, compresslevel=1)
+
+
+def record_by_record(data: bytes) -> int:
+    "Quality, composition, length and duplication counted one record at a time"
+
+    lengths = collections.Counter()
+    qualities = collections.defaultdict(collections.Counter)
+    bases = collections.defaultdict(collections.Counter)
+    prefixes = set()
+    reads = 0
+
+    lines = gzip.decompress(data).split(b"\n")
+
+    for sequence, quality in zip(lines[1::4], lines[3::4]):
+        reads += 1
+        lengths[len(sequence)] += 1
+        prefixes.add(sequence[:48])
+
+        for position, (base, score) in enumerate(zip(sequence, quality)):
+            bases[position][base] += 1
+            qualities[position][score] += 1
+
+    return reads
+
+
+def vectorized(data: bytes) -> int:
+    "Decompressed and counted the way transfer does while downloading"
+
+    statistics = Statistics()
+    decompressor = GzipDecompressor()
+    data = memoryview(data)
+
+    for start in range(0, len(data), READ_SIZE):
+        statistics.update(decompressor.decompress(data[start : start + READ_SIZE]))
+
+    return statistics.summary()["reads"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reads", type=int, default=200_000)
+    parser.add_argument("--length", type=int, default=100)
+    arguments = parser.parse_args()
+
+    data = synthetic(arguments.reads, arguments.length)
+
+    for name, implementation in (
+        ("record by record", record_by_record),
+        ("vectorized", vectorized),
+    ):
+        start = time.perf_counter()
+        reads = implementation(data)
+        elapsed = time.perf_counter() - start
+
+        assert reads == arguments.reads
+        print(f"{name:16}: {reads / elapsed:12,.0f} reads/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"Measure how fast the worker copies a tool's output to its log, against the previous line-by-line copy"
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from tee import CHUNK_SIZE, LogTarget, open_log, tee
+
+
+async def duplicate(stream, streams):
+    async for line in stream:
+        for target in streams:
+            target.write(line.decode())
+
+
+async def line_by_line(command: str, log: Path, console):
+    process = await asyncio.create_subprocess_shell(
+        command, stdout=asyncio.subprocess.PIPE, limit=2**30
+    )
+
+    with open(log, "a") as stdout_log:
+        await duplicate(process.stdout, (console, stdout_log))
+
+    return await process.wait()
+
+
+async def chunked(command: str, log: Path, console):
+    process = await asyncio.create_subprocess_shell(
+        command, stdout=asyncio.subprocess.PIPE, limit=CHUNK_SIZE
+    )
+
+    with open_log(log) as stdout_log:
+        await tee(
+            process.stdout, [LogTarget(stdout_log), LogTarget(console, lossy=True)]
+        )
+
+    return await process.wait()
+
+
+def measure(implementation, command: str, size: int, console) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        asyncio.run(implementation(command, Path(directory) / "log", console))
+        elapsed = time.perf_counter() - start
+
+    return size / elapsed / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=int, default=512)
+    parser.add_argument("--line-length", type=int, default=100)
+    arguments = parser.parse_args()
+
+    size = arguments.megabytes * 2**20
+    line = "x" * (arguments.line_length - 1)
+    workloads = {
+        "lines": f"yes {line} | head -c {size}",
+        "no newlines": f"head -c {size} /dev/zero | tr '\\0' x",
+    }
+
+    with open(os.devnull, "w") as text_console, open(os.devnull, "wb") as console:
+        for name, command in workloads.items():
+            print(f"{name}:")
+
+            throughput = measure(line_by_line, command, size, text_console)
+            print(f"  line by line: {throughput:8.1f} MiB/s")
+
+            for compression in ("", "gzip", "zstd"):
+                os.environ["LOG_COMPRESSION"] = compression
+
+                try:
+                    throughput = measure(chunked, command, size, console)
+                except ImportError:
+                    continue
+
+                print(f"  chunked {compression or 'plain':5}: {throughput:8.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
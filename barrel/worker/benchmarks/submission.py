@@ -0,0 +1,103 @@
+"Measure job submissions per second against a stubbed Batch client"
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from pathlib import Path
+
+os.environ.setdefault("FILE_SYSTEM_MOUNT_POINT", tempfile.mkdtemp())
+os.environ.setdefault("STUDY_NAME", "benchmark")
+os.environ.setdefault("ANALYSIS_NAME", "submission")
+os.environ.setdefault("JOB_QUEUE_ARN", "benchmark")
+os.environ.setdefault("WORKER_JOB_DEFINITION_NAME", "benchmark")
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+import worker
+
+from botocore.exceptions import ClientError
+
+
+class StubBatch:
+    "Answers SubmitJob after a fixed latency and throttles above a quota, like Batch"
+
+    def __init__(self, latency: float, quota: float, construction_time: float):
+        time.sleep(construction_time)
+        self.latency = latency
+        self.bucket = worker.TokenBucket(quota)
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def submit_job(self, **parameters):
+        time.sleep(self.latency)
+
+        if self.bucket.try_acquire():
+            with self.lock:
+                self.throttled += 1
+            raise ClientError(
+                {"Error": {"Code": "TooManyRequestsException", "Message": "Too Many"}},
+                "SubmitJob",
+            )
+
+        return {"jobId": str(uuid.uuid4())}
+
+
+def serial(jobs: int, arguments) -> float:
+    "The previous behaviour: a new client and a blocking call for every job"
+
+    start = time.perf_counter()
+    submitted = []
+
+    for _ in range(jobs):
+        batch = StubBatch(arguments.latency, arguments.quota, arguments.construction)
+        submitted.append(batch.submit_job(dependsOn=submitted[-10:-9])["jobId"])
+
+    return time.perf_counter() - start
+
+
+def pipelined(jobs: int, arguments) -> float:
+    client = StubBatch(arguments.latency, arguments.quota, arguments.construction)
+    worker.backend = worker.Submitter(
+        client=client, rate=arguments.rate, threads=arguments.threads
+    )
+
+    start = time.perf_counter()
+    submitted = []
+
+    for _ in range(jobs):
+        # every job depends on one submitted a little earlier, as pipeline steps do
+        depends_on = submitted[-10:-9]
+        submitted.append(worker.execute(":", "BENCHMARK", depends_on=depends_on))
+
+    worker.backend.drain()
+    elapsed = time.perf_counter() - start
+
+    print(f"  throttled responses: {client.throttled}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--construction", type=float, default=0.02)
+    parser.add_argument("--quota", type=float, default=50)
+    parser.add_argument("--rate", type=float, default=worker.SUBMIT_JOB_RATE)
+    parser.add_argument("--threads", type=int, default=worker.SUBMISSION_THREADS)
+    arguments = parser.parse_args()
+
+    serial_jobs = min(arguments.jobs, 100)
+    elapsed = serial(serial_jobs, arguments)
+    print(f"serial:    {serial_jobs / elapsed:8.1f} submissions/s")
+
+    elapsed = pipelined(arguments.jobs, arguments)
+    print(f"pipelined: {arguments.jobs / elapsed:8.1f} submissions/s")
+
+
+if __name__ == "__main__":
+    main()
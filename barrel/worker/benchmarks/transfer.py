@@ -0,0 +1,111 @@
+"Measure S3 download throughput against a moto server, against the previous single-stream download"
+
+import argparse
+import boto3
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+
+from boto3.s3.transfer import TransferConfig
+from moto.server import ThreadedMotoServer
+from pathlib import Path
+
+os.environ.setdefault("FILE_SYSTEM_MOUNT_POINT", tempfile.mkdtemp())
+os.environ.setdefault("STUDY_NAME", "benchmark")
+os.environ.setdefault("ANALYSIS_NAME", "transfer")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from transfer import download
+
+BUCKET = "benchmark"
+KEY = "reads.fastq.gz"
+
+
+def free_port() -> int:
+    with socket.socket() as connection:
+        connection.bind(("127.0.0.1", 0))
+        return connection.getsockname()[1]
+
+
+def single_stream(endpoint: str, destination: Path, arguments):
+    "The previous behaviour: one stream, capped at 4 MB/s unless told otherwise"
+
+    s3 = boto3.resource("s3", endpoint_url=endpoint)
+    configuration = TransferConfig(
+        use_threads=False, max_bandwidth=arguments.max_bandwidth
+    )
+    s3.Bucket(BUCKET).download_file(KEY, str(destination), Config=configuration)
+
+
+def ranged(endpoint: str, destination: Path, arguments):
+    s3 = boto3.client(
+        "s3",
+        endpoint_url=endpoint,
+        config=boto3.session.Config(max_pool_connections=arguments.concurrency),
+    )
+    download(s3, BUCKET, KEY, destination, arguments.concurrency, arguments.part_size)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=int, default=256)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--part-size", type=int, default=16 * 2**20)
+    parser.add_argument(
+        "--max-bandwidth",
+        type=int,
+        default=4_000_000,
+        help="Cap of the previous download in bytes per second",
+    )
+    arguments = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    port = free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+    server.start()
+    endpoint = f"http://127.0.0.1:{port}"
+
+    size = arguments.megabytes * 2**20
+
+    try:
+        s3 = boto3.client("s3", endpoint_url=endpoint)
+        s3.create_bucket(Bucket=BUCKET)
+
+        with tempfile.TemporaryDirectory() as directory:
+            source = Path(directory) / "source"
+            source.write_bytes(os.urandom(size))
+
+            # uploaded in parts, so that verification covers multipart ETags
+            s3.upload_file(
+                str(source),
+                BUCKET,
+                KEY,
+                Config=TransferConfig(multipart_chunksize=8 * 2**20),
+            )
+
+            for name, implementation in (
+                ("single stream", single_stream),
+                ("ranged", ranged),
+            ):
+                destination = Path(directory) / name
+
+                start = time.perf_counter()
+                implementation(endpoint, destination, arguments)
+                elapsed = time.perf_counter() - start
+
+                assert destination.read_bytes() == source.read_bytes()
+                print(f"{name:14}: {size / elapsed / 2**20:8.1f} MiB/s")
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
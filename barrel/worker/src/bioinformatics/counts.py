@@ -0,0 +1,464 @@
+import argparse
+import numpy as np
+import os
+import re
+import subprocess
+import worker
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import StrEnum
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+from bioinformatics.data import Sample
+from bioinformatics.genome import Annotation, Genome, load_annotation
+from bioinformatics.software import SAMTOOLS
+
+BLOCK_SIZE = 1 << 24
+
+# positions are keyed by chromosome and strand in the bits above those of the position
+POSITION_BITS = 40
+
+# genes of the fragments, and of the parts of the genome, that no one gene explains
+NO_FEATURE = -1
+AMBIGUOUS = -2
+
+SPECIAL_COUNTS = [
+    "__no_feature",
+    "__ambiguous",
+    "__not_aligned",
+    "__alignment_not_unique",
+]
+
+UNMAPPED, REVERSE, SECOND_MATE = 0x4, 0x10, 0x80
+SECONDARY, SUPPLEMENTARY = 0x100, 0x800
+
+# fields of an alignment up to its CIGAR, each match taking a whole line
+SAM_RECORD = re.compile(
+    rb"([^\t\n]*)\t(\d+)\t([^\t\n]*)\t(\d+)\t\d+\t([^\t\n]*)\t[^\n]*\n"
+)
+# alignments to more than one place
+MULTIPLE_HITS = re.compile(rb"\tNH:i:(?!1\s)")
+
+# CIGAR operations that align bases, and those that move along the reference
+ALIGNED = np.zeros(256, dtype=bool)
+ALIGNED[list(b"M=X")] = True
+ON_REFERENCE = np.zeros(256, dtype=bool)
+ON_REFERENCE[list(b"MDN=X")] = True
+
+
+class Strandedness(StrEnum):
+    UNSTRANDED = "unstranded"
+    # the first read of a fragment on the strand of its gene, or on the other one
+    FORWARD = "forward"
+    REVERSE = "reverse"
+
+
+def ranges(first: np.ndarray, count: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    "Index of the range and value of every item of the ranges from first, count long"
+
+    owners = np.repeat(np.arange(len(first)), count)
+    offsets = np.arange(len(owners)) - np.repeat(np.cumsum(count) - count, count)
+
+    return owners, first[owners] + offsets
+
+
+def keys(chromosomes: np.ndarray, strands: np.ndarray, positions: np.ndarray):
+    "Positions ordered by chromosome and strand, so one sorted array indexes the genome"
+
+    return ((2 * chromosomes + strands) << POSITION_BITS) + positions
+
+
+@dataclass
+class GeneIndex:
+    "Exons cut into segments at every exon boundary, each with the one gene that covers it"
+
+    # segment i runs from boundaries[i - 1] to boundaries[i]
+    boundaries: np.ndarray
+    genes: np.ndarray
+    stranded: bool
+
+    @classmethod
+    def build(cls, annotation: Annotation, stranded: bool) -> "GeneIndex":
+        exons = annotation.rows("exon")
+        chromosomes = annotation.chromosome[exons].astype(np.int64)
+        strands = (annotation.strand[exons] < 0).astype(np.int64) * stranded
+        starts = keys(chromosomes, strands, annotation.start[exons])
+        ends = keys(chromosomes, strands, annotation.end[exons])
+
+        boundaries = np.unique(np.concatenate((starts, ends)))
+
+        # the segments every exon covers, then the genes that cover every segment
+        first = np.searchsorted(boundaries, starts) + 1
+        owners, segments = ranges(first, np.searchsorted(boundaries, ends) + 1 - first)
+        pairs = np.unique(
+            np.stack((segments, annotation.gene[exons][owners].astype(np.int64))),
+            axis=1,
+        )
+        segments, first, covering = np.unique(
+            pairs[0], return_index=True, return_counts=True
+        )
+
+        genes = np.full(len(boundaries) + 1, NO_FEATURE, dtype=np.int64)
+        genes[segments] = np.where(covering == 1, pairs[1][first], AMBIGUOUS)
+
+        return cls(boundaries, genes, stranded)
+
+    def assign(
+        self, fragments: np.ndarray, starts: np.ndarray, ends: np.ndarray
+    ) -> np.ndarray:
+        "Gene of every fragment, given in order, from the segments its blocks overlap"
+
+        first = np.searchsorted(self.boundaries, starts, side="right")
+        count = np.searchsorted(self.boundaries, ends) + 1 - first
+        owners, segments = ranges(first, count)
+
+        genes = self.genes[segments]
+        first = np.flatnonzero(np.diff(fragments[owners], prepend=-1))
+
+        # like the union mode of htseq-count, a fragment counts for a gene if it is the only one
+        ambiguous = np.maximum.reduceat(genes == AMBIGUOUS, first)
+        lowest = np.minimum.reduceat(
+            np.where(genes < 0, np.iinfo(np.int64).max, genes), first
+        )
+        highest = np.maximum.reduceat(genes, first)
+
+        assigned = np.where(highest < 0, NO_FEATURE, highest)
+        assigned[ambiguous | ((highest >= 0) & (lowest != highest))] = AMBIGUOUS
+
+        return assigned
+
+
+def cigar_blocks(
+    cigars: list[bytes], positions: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    "Record, start and end of every aligned block of the records, from all CIGARs at once"
+
+    joined = np.frombuffer(b"".join(cigars), dtype=np.uint8)
+    ends = np.cumsum(np.fromiter(map(len, cigars), dtype=np.int64, count=len(cigars)))
+
+    # every operation ends a run of digits, whose value is summed a digit at a time
+    is_operation = (joined < ord("0")) | (joined > ord("9"))
+    operations = np.flatnonzero(is_operation)
+    digits = np.flatnonzero(~is_operation)
+    runs = np.cumsum(is_operation)[digits]
+    lengths = np.zeros(len(operations), dtype=np.int64)
+    np.add.at(
+        lengths,
+        runs,
+        (joined[digits] - ord("0")) * 10 ** (operations[runs] - 1 - digits),
+    )
+
+    records = np.searchsorted(ends, operations, side="right")
+    operations = joined[operations]
+
+    # where every operation starts on the reference, from the start of its record
+    moves = np.where(ON_REFERENCE[operations], lengths, 0)
+    offsets = np.cumsum(moves) - moves
+    offsets -= offsets[np.searchsorted(records, records)]
+    starts = positions[records] - 1 + offsets
+
+    aligned = ALIGNED[operations]
+    return records[aligned], starts[aligned], starts[aligned] + lengths[aligned]
+
+
+def fragment_end(buffer: bytes) -> int:
+    "Position after the last line whose fragment surely ends within the buffer, or 0"
+
+    end = buffer.rfind(b"\n", 0, len(buffer) - 1) + 1
+    name = buffer[end : buffer.find(b"\t", end) + 1]
+
+    # the records of a fragment are consecutive, and the next block may hold more of them
+    while end and buffer.startswith(name, buffer.rfind(b"\n", 0, end - 1) + 1):
+        end = buffer.rfind(b"\n", 0, end - 1) + 1
+
+    return end
+
+
+def batches(file: BinaryIO) -> Iterator[bytes]:
+    "Blocks of whole lines of a SAM file, never splitting the records of a fragment"
+
+    buffer = b""
+
+    while data := file.read(BLOCK_SIZE):
+        buffer += data
+        end = fragment_end(buffer[: buffer.rfind(b"\n") + 1])
+
+        if end:
+            yield buffer[:end]
+            buffer = buffer[end:]
+
+    if buffer.strip():
+        yield buffer if buffer.endswith(b"\n") else buffer + b"\n"
+
+
+def header_end(batch: bytes) -> int:
+    "Position after the header lines at the start of a SAM file"
+
+    end = 0
+
+    while batch.startswith(b"@", end):
+        end = batch.index(b"\n", end) + 1
+
+    return end
+
+
+class Counter:
+    "Reads and pairs counted by gene, a batch of SAM records at a time"
+
+    def __init__(self, annotation: Annotation, strandedness: Strandedness):
+        self.strandedness = strandedness
+        self.index = GeneIndex.build(
+            annotation, stranded=strandedness != Strandedness.UNSTRANDED
+        )
+        self.chromosomes = {
+            name.encode(): code for code, name in enumerate(annotation.chromosomes)
+        }
+        self.counts = np.zeros(len(annotation.genes), dtype=np.int64)
+        self.special = dict.fromkeys(SPECIAL_COUNTS, 0)
+
+    def add(self, batch: bytes):
+        batch = batch[header_end(batch) :]
+        alignments = SAM_RECORD.findall(batch)
+
+        if not alignments:
+            return
+
+        # alignments, lines and their positions in the batch correspond one to one
+        lines = np.flatnonzero(np.frombuffer(batch, dtype=np.uint8) == ord("\n"))
+
+        if len(lines) != len(alignments):
+            raise ValueError("The alignments are not SAM records")
+
+        multiple = np.zeros(len(lines), dtype=bool)
+        multiple[
+            np.searchsorted(
+                lines, [hit.start() for hit in MULTIPLE_HITS.finditer(batch)]
+            )
+        ] = True
+
+        names, flags, chromosomes, positions, cigars = map(np.array, zip(*alignments))
+        flags = flags.astype(np.int64)
+
+        # a fragment is the run of records of one name, counted once from its primary records
+        records = np.flatnonzero(flags & (SECONDARY | SUPPLEMENTARY) == 0)
+
+        if not len(records):
+            return
+
+        names = names[records]
+        fragments = np.cumsum(np.concatenate(([0], names[1:] != names[:-1])))
+        flags = flags[records]
+
+        mapped = flags & UNMAPPED == 0
+        multiple = multiple[records]
+
+        aligned = np.zeros(fragments[-1] + 1, dtype=bool)
+        aligned[fragments[mapped]] = True
+        not_unique = np.zeros_like(aligned)
+        not_unique[fragments[mapped & multiple]] = True
+
+        self.special["__not_aligned"] += int(np.sum(~aligned))
+        self.special["__alignment_not_unique"] += int(np.sum(not_unique))
+
+        counted = mapped & ~not_unique[fragments]
+        records, fragments, flags = records[counted], fragments[counted], flags[counted]
+
+        if not len(records):
+            return
+
+        # chromosomes without genes get a code of their own, which no segment has
+        chromosomes, codes = np.unique(chromosomes[records], return_inverse=True)
+        codes = np.array(
+            [self.chromosomes.get(name, len(self.chromosomes)) for name in chromosomes]
+        )[codes]
+        positions = positions[records].astype(np.int64)
+
+        # the strand of a fragment is the one its first read aligns to
+        strands = ((flags & REVERSE) > 0) ^ ((flags & SECOND_MATE) > 0)
+        strands ^= self.strandedness == Strandedness.REVERSE
+        strands &= self.index.stranded
+
+        blocks, starts, ends = cigar_blocks(cigars[records].tolist(), positions)
+        prefix = keys(codes[blocks], strands[blocks].astype(np.int64), 0)
+
+        genes = self.index.assign(fragments[blocks], prefix + starts, prefix + ends)
+
+        self.special["__no_feature"] += int(np.sum(genes == NO_FEATURE))
+        self.special["__ambiguous"] += int(np.sum(genes == AMBIGUOUS))
+        self.counts += np.bincount(genes[genes >= 0], minlength=len(self.counts))
+
+
+@contextmanager
+def open_alignments(
+    alignments: Path, samtools: str = "samtools", reference: Path = None
+) -> Iterator[BinaryIO]:
+    "SAM records of a SAM file, or of a BAM or CRAM file decoded by samtools"
+
+    if alignments.suffix == ".sam":
+        with open(alignments, "rb") as file:
+            yield file
+        return
+
+    command = [samtools, "view", "--threads", "2", str(alignments)]
+    command += ["--reference", str(reference)] if reference else []
+
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+        yield process.stdout
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def count(
+    alignments: Path,
+    annotation: Annotation,
+    strandedness: Strandedness,
+    samtools: str = "samtools",
+    reference: Path = None,
+) -> Counter:
+    counter = Counter(annotation, strandedness)
+
+    with open_alignments(alignments, samtools, reference) as file:
+        for batch in batches(file):
+            counter.add(batch)
+
+    return counter
+
+
+def write_counts(output: Path, name: str, annotation: Annotation, counter: Counter):
+    "Write the count of every gene, then the fragments counted for none, like htseq-count"
+
+    temporary = output.with_name(f"{output.name}.tmp")
+
+    with open(temporary, "w") as file:
+        print(f"gene\t{name}", file=file)
+
+        for gene, value in zip(annotation.genes, counter.counts.tolist()):
+            print(f"{gene}\t{value}", file=file)
+
+        for special, value in counter.special.items():
+            print(f"{special}\t{value}", file=file)
+
+    os.replace(temporary, output)
+
+
+def matrix(counts: list[Path], output: Path):
+    "Join the counts of the samples, one column each, checking they count the same genes"
+
+    genes, columns = None, []
+
+    for path in counts:
+        with open(path) as file:
+            rows = [line.rstrip("\n").split("\t") for line in file]
+
+        if genes is not None and [row[0] for row in rows] != genes:
+            raise ValueError(f"{path} counts other genes than {counts[0]}")
+
+        genes = [row[0] for row in rows]
+        columns.append([row[1] for row in rows])
+
+    temporary = output.with_name(f"{output.name}.tmp")
+
+    with open(temporary, "w") as file:
+        for gene, values in zip(genes, zip(*columns)):
+            print("\t".join([gene, *values]), file=file)
+
+    os.replace(temporary, output)
+
+
+def count_genes(
+    samples: list[Sample],
+    genome: Genome,
+    location: Path,
+    strandedness: Strandedness = Strandedness.UNSTRANDED,
+    samtools: SAMTOOLS = None,
+) -> worker.Job:
+    "Count the fragments of every gene, a sample per job, then join the counts in one matrix"
+
+    # the annotation is parsed once, before the jobs that load it
+    annotation_parsing = worker.execute(
+        f"gtf {genome.gtf_file}",
+        job_name="PARSE_ANNOTATION",
+        memory=8192,
+        depends_on=[genome.files_download],
+        inputs=[genome.gtf_file],
+    )
+
+    outputs = [location / f"{sample.id}.counts.tsv" for sample in samples]
+    pending = [
+        (sample, output)
+        for sample, output in zip(samples, outputs)
+        if worker.cache is not None or not output.exists()
+    ]
+
+    # BAM and CRAM files are decoded by samtools
+    decoding = f"--samtools {samtools.executable}" if samtools else ""
+    counting = []
+
+    if pending:
+        counting.append(
+            worker.execute_array(
+                [f"""
+                        mkdir -p {location}
+                        counts count {sample.alignment}                     \
+                            --gtf {genome.gtf_file}                         \
+                            --name {sample.id}                              \
+                            --strandedness {strandedness}                   \
+                            --reference {genome.fasta_file}                 \
+                            --output {output} {decoding}
+                    """ for sample, output in pending],
+                job_name="COUNT_GENES",
+                vcpu=2,
+                memory=8192,
+                depends_on=[annotation_parsing]
+                + ([samtools.installation] if samtools else []),
+                each_depends_on=[sample.aligning for sample, _ in pending],
+            )
+        )
+
+    return worker.execute(
+        f"counts matrix {' '.join(map(str, outputs))} --output {location}/counts.tsv",
+        job_name="COUNTS_MATRIX",
+        depends_on=counting,
+        outputs=[location / "counts.tsv"],
+        inputs=outputs,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count aligned reads by gene")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    counting = subparsers.add_parser(
+        "count", help="Count the fragments of a SAM, BAM or CRAM file by gene"
+    )
+    counting.add_argument("alignments", type=Path)
+    counting.add_argument("--gtf", type=Path, required=True)
+    counting.add_argument("--name", required=True, help="Column name of the counts")
+    counting.add_argument(
+        "--strandedness",
+        type=Strandedness,
+        choices=list(Strandedness),
+        default=Strandedness.UNSTRANDED,
+    )
+    counting.add_argument("--samtools", default="samtools")
+    counting.add_argument("--reference", type=Path, help="FASTA file of CRAM files")
+    counting.add_argument("--output", type=Path, required=True)
+    joining = subparsers.add_parser("matrix", help="Join the counts of samples")
+    joining.add_argument("counts", nargs="+", type=Path)
+    joining.add_argument("--output", type=Path, required=True)
+    arguments = parser.parse_args()
+
+    if arguments.action == "matrix":
+        return matrix(arguments.counts, arguments.output)
+
+    annotation = load_annotation(arguments.gtf)
+    counter = count(
+        arguments.alignments,
+        annotation,
+        arguments.strandedness,
+        arguments.samtools,
+        arguments.reference,
+    )
+    write_counts(arguments.output, arguments.name, annotation, counter)
@@ -1,5 +1,7 @@
+import worker
+
 from dataclasses import dataclass
-from transfer import transfer
+from transfer import transfer, transfer_bulk
 from pathlib import Path
 from urllib.parse import urlparse
 
@@ -8,11 +10,23 @@ from urllib.parse import urlparse
 class Read:
     source: str
     location: Path
+    download: worker.Job = None
+    # a streamed read is fetched by the jobs that use it and never stored at location
+    stream: bool = False
 
     def __post_init__(self):
         self.location = Path(self.location)
         self.origin = urlparse(self.source).scheme
 
+        if self.stream and self.origin != "s3":
+            raise NotImplementedError
+
+        if self.stream:
+            self.download = worker.wait([])
+
+        if self.download is not None:
+            return
+
         if self.origin in ["s3", "file"]:
             self.download = transfer(source=self.source, destination=self.location)
         elif self.origin == "job":
@@ -21,6 +35,26 @@ class Read:
             raise NotImplementedError
 
 
+def download_reads(reads: list[tuple[str, Path]], stream: bool = False) -> list[Read]:
+    "Create reads from (source, location) pairs, downloading them with a few bulk transfer jobs"
+
+    if stream:
+        return [Read(source, location, stream=True) for source, location in reads]
+
+    if any(urlparse(source).scheme not in ["s3", "file"] for source, _ in reads):
+        raise NotImplementedError
+
+    # basic quality statistics are computed from the bytes as they are downloaded
+    downloads = transfer_bulk(
+        [(source, Path(location)) for source, location in reads], statistics=True
+    )
+
+    return [
+        Read(source, location, download=download)
+        for (source, location), download in zip(reads, downloads)
+    ]
+
+
 @dataclass
 class Sample:
     id: str
@@ -0,0 +1,343 @@
+import argparse
+import gzip
+import numpy as np
+
+from pathlib import Path
+from typing import BinaryIO
+
+BLOCK_SIZE = 1 << 22
+LINES_PER_RECORD = 4
+
+# Phred+33 qualities, and bytes counted as A, C, G, T or, except padding, N
+QUALITIES = 94
+BASES = "ACGTN"
+BASE_BYTES = np.zeros((256, len(BASES)), dtype=np.int64)
+BASE_BYTES[1:, BASES.index("N")] = 1
+for index, base in enumerate("ACGT"):
+    BASE_BYTES[[ord(base), ord(base.lower())]] = np.eye(len(BASES))[index]
+
+# duplication is estimated from the number of distinct first bases of the reads, which a
+# HyperLogLog of 2**REGISTER_BITS registers counts to within about 1%
+DUPLICATION_PREFIX = 48
+REGISTER_BITS = 14
+RANK_BITS = 64 - REGISTER_BITS
+
+
+def open_fastq(path: Path) -> BinaryIO:
+    return gzip.open(path, "rb") if path.suffix == ".gz" else open(path, "rb")
+
+
+def record_end(buffer: bytes, limit: int = None) -> int:
+    "Position after the last whole record that ends within limit, or 0 without one"
+
+    limit = len(buffer) if limit is None else limit
+    lines = buffer.count(b"\n", 0, limit)
+    end = buffer.rfind(b"\n", 0, limit) + 1
+
+    for _ in range(lines % LINES_PER_RECORD):
+        end = buffer.rfind(b"\n", 0, end - 1) + 1
+
+    return end
+
+
+class Records:
+    "Reads whole FASTQ records in blocks, so that no record is ever split"
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.buffer = b""
+
+    def read(self) -> bool:
+        data = self.file.read(BLOCK_SIZE)
+        self.buffer += data
+
+        # a last line without its newline still ends a record
+        if not data and self.buffer and not self.buffer.endswith(b"\n"):
+            self.buffer += b"\n"
+
+        return bool(data)
+
+    def block(self) -> tuple[bytes, int]:
+        "The next block of whole records and how many records it holds"
+
+        while self.read() and self.buffer.count(b"\n") < LINES_PER_RECORD:
+            pass
+
+        end = record_end(self.buffer)
+
+        block, self.buffer = self.buffer[:end], self.buffer[end:]
+        return block, block.count(b"\n") // LINES_PER_RECORD
+
+    def take(self, records: int, size: int) -> bytes:
+        "Exactly the given number of records, expected to take about size bytes"
+
+        lines = records * LINES_PER_RECORD
+
+        while self.buffer.count(b"\n") < lines:
+            if not self.read():
+                raise ValueError("The mates have different numbers of records")
+
+        # mates have records of similar lengths, so the end is near the expected size
+        end = self.buffer.rfind(b"\n", 0, size) + 1
+        seen = self.buffer.count(b"\n", 0, end)
+
+        for _ in range(lines - seen):
+            end = self.buffer.index(b"\n", end) + 1
+
+        for _ in range(seen - lines):
+            end = self.buffer.rfind(b"\n", 0, end - 1) + 1
+
+        block, self.buffer = self.buffer[:end], self.buffer[end:]
+        return block
+
+    def finished(self) -> bool:
+        return not self.buffer.strip() and not self.read() and not self.buffer.strip()
+
+
+def matrix(lines: list[bytes], width: int) -> np.ndarray:
+    "Lines as the rows of a matrix, padded with zero bytes to the width"
+
+    rows = b"".join(line.ljust(width, b"\0") for line in lines)
+    return np.frombuffer(rows, dtype=np.uint8).reshape(len(lines), width)
+
+
+def column_counts(rows: np.ndarray) -> np.ndarray:
+    "Counts of every byte value in every column"
+
+    counts = [
+        np.bincount(column, minlength=256) for column in np.ascontiguousarray(rows.T)
+    ]
+    return np.stack(counts) if counts else np.zeros((0, 256), dtype=np.int64)
+
+
+def mix(hashes: np.ndarray) -> np.ndarray:
+    "Spread the bits of 64-bit hashes, so that every bit depends on every input bit"
+
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xBF58476D1CE4E5B9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94D049BB133111EB)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+class Statistics:
+    "Quality, composition, length and duplication of FASTQ records, fed in pieces of any size"
+
+    def __init__(self):
+        self.buffer = b""
+        self.reads = 0
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.qualities = np.zeros((0, QUALITIES), dtype=np.int64)
+        self.bases = np.zeros((0, len(BASES)), dtype=np.int64)
+        self.registers = np.zeros(2**REGISTER_BITS, dtype=np.int64)
+
+    def update(self, data: bytes):
+        self.buffer += data
+
+        # records are counted a block at a time, which bounds the memory of the arrays
+        while len(self.buffer) >= BLOCK_SIZE:
+            end = record_end(self.buffer, BLOCK_SIZE) or record_end(self.buffer)
+
+            if not end:
+                return
+
+            self.add(self.buffer[:end])
+            self.buffer = self.buffer[end:]
+
+    def add(self, block: bytes):
+        # splitting and joining lines copies them at the speed of C, into matrices of reads
+        lines = block.split(b"\n")
+        records = len(lines) // LINES_PER_RECORD
+
+        if records == 0:
+            return
+
+        lines = lines[: LINES_PER_RECORD * records]
+
+        if b"\r" in block:
+            lines = [line.rstrip(b"\r") for line in lines]
+
+        if not all(header.startswith(b"@") for header in lines[::4]):
+            raise ValueError("The records are not FASTQ records")
+
+        sequences, qualities = lines[1::4], lines[3::4]
+        lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=records)
+        length = lengths.max()
+
+        self.reads += records
+        self.lengths = self.count(self.lengths, np.bincount(lengths))
+
+        bases = matrix(sequences, max(length, DUPLICATION_PREFIX))
+        self.bases = self.count(
+            self.bases, column_counts(bases[:, :length]) @ BASE_BYTES
+        )
+
+        qualities = matrix(qualities, max(map(len, qualities)))
+        self.qualities = self.count(
+            self.qualities, column_counts(qualities)[:, 33 : 33 + QUALITIES]
+        )
+
+        hashes = self.hash(bases[:, :DUPLICATION_PREFIX], lengths)
+
+        # the rank is the position of the first set bit of the hash below the register bits
+        _, bit_length = np.frexp(hashes & np.uint64(2**RANK_BITS - 1))
+        np.maximum.at(
+            self.registers, hashes >> np.uint64(RANK_BITS), RANK_BITS + 1 - bit_length
+        )
+
+    @staticmethod
+    def count(total: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        "Add counts indexed by position to a total, growing it for longer reads"
+
+        if len(counts) > len(total):
+            grown = np.zeros_like(counts)
+            grown[: len(total)] = total
+            total = grown
+
+        total[: len(counts)] += counts
+        return total
+
+    @staticmethod
+    def hash(prefixes: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        "Hashes of the first bases and the lengths of the reads"
+
+        words = np.ascontiguousarray(prefixes).view(np.uint64)
+        hashes = mix(lengths.astype(np.uint64))
+
+        for word in words.T:
+            hashes = mix(hashes ^ word)
+
+        return hashes
+
+    def distinct(self) -> float:
+        "HyperLogLog estimate of the number of distinct reads"
+
+        registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        estimate = alpha * registers**2 / np.sum(2.0**-self.registers)
+        empty = np.count_nonzero(self.registers == 0)
+
+        # few distinct reads leave registers empty, which linear counting handles better
+        if estimate <= 2.5 * registers and empty:
+            return registers * np.log(registers / empty)
+
+        return float(estimate)
+
+    def summary(self) -> dict:
+        if self.buffer.strip():
+            self.add(
+                self.buffer if self.buffer.endswith(b"\n") else self.buffer + b"\n"
+            )
+            self.buffer = b""
+
+        bases = self.bases.sum(axis=0)
+        qualities = np.arange(QUALITIES)
+        observed = self.qualities.sum(axis=1)
+
+        return {
+            "reads": self.reads,
+            "bases": int(bases.sum()),
+            "gc_content": 100 * float(bases[1:3].sum() / max(bases[:4].sum(), 1)),
+            "n_content": 100 * float(bases[4] / max(bases.sum(), 1)),
+            "length_histogram": {
+                length: int(count) for length, count in enumerate(self.lengths) if count
+            },
+            "mean_quality": (self.qualities @ qualities / np.maximum(observed, 1))
+            .round(2)
+            .tolist(),
+            # counts of every quality at every position, and of every base at every position
+            "quality_counts": self.qualities.tolist(),
+            "base_counts": {
+                base: self.bases[:, index].tolist() for index, base in enumerate(BASES)
+            },
+            "deduplicated_percentage": (
+                min(100 * self.distinct() / self.reads, 100) if self.reads else None
+            ),
+        }
+
+
+def deal(block: bytes, first: int, count: int) -> list[bytes]:
+    "The records of a block dealt out to count chunks in turn, the first of them to chunk first"
+
+    lines = block.split(b"\n")[:-1]
+    records = [
+        b"\n".join(lines[start : start + LINES_PER_RECORD]) + b"\n"
+        for start in range(0, len(lines), LINES_PER_RECORD)
+    ]
+
+    return [
+        b"".join(records[(chunk - first) % count :: count]) for chunk in range(count)
+    ]
+
+
+def split(mates: list[Path], chunks: list[list[Path]]):
+    "Split the mates into chunks in one pass, dealing the records out in turn so that chunk i of every mate holds the same reads"
+
+    count = len(chunks[0])
+    readers = [Records(open_fastq(mate)) for mate in mates]
+    outputs = [[open(chunk, "wb") for chunk in mate] for mate in chunks]
+
+    try:
+        # records dealt so far, which decides the chunk of the next one
+        dealt = 0
+
+        while True:
+            block, records = readers[0].block()
+
+            if not block:
+                break
+
+            blocks = [block] + [
+                reader.take(records, len(block)) for reader in readers[1:]
+            ]
+
+            for mate, files in zip(blocks, outputs):
+                for file, records_of_chunk in zip(
+                    files, deal(mate, dealt % count, count)
+                ):
+                    file.write(records_of_chunk)
+
+            dealt += records
+
+        if not readers[0].finished():
+            raise ValueError(f"{mates[0]} ends with a partial record")
+
+        if not all(reader.finished() for reader in readers[1:]):
+            raise ValueError("The mates have different numbers of records")
+    finally:
+        for reader in readers:
+            reader.file.close()
+
+        for files in outputs:
+            for file in files:
+                file.close()
+
+
+def chunk_files(mates: list[Path], directory: Path, count: int) -> list[list[Path]]:
+    "Files of every chunk of every mate, uncompressed since they are read once"
+
+    return [
+        [
+            directory / f"{index}.{mate.name.removesuffix('.gz')}"
+            for index in range(count)
+        ]
+        for mate in mates
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split FASTQ files")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    splitting = subparsers.add_parser(
+        "split", help="Split mates into chunks holding the same reads"
+    )
+    splitting.add_argument("mates", nargs="+", type=Path)
+    splitting.add_argument("--chunks", type=int, required=True)
+    splitting.add_argument("--directory", type=Path, required=True)
+    arguments = parser.parse_args()
+
+    arguments.directory.mkdir(parents=True, exist_ok=True)
+
+    chunks = chunk_files(arguments.mates, arguments.directory, arguments.chunks)
+    split(arguments.mates, chunks)
@@ -1,8 +1,53 @@
+import argparse
+import array
+import gzip
+import mmap
+import numpy as np
+import os
+import re
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
 import worker
 
+from bioinformatics import store
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import StrEnum
+from functools import cached_property
 from pathlib import Path
+from typing import Iterator
+
+ENSEMBL_URL = os.environ.get("ENSEMBL_URL", "http://ftp.ensembl.org/pub")
+DOWNLOAD_THREADS = int(os.environ.get("GENOME_DOWNLOAD_THREADS", 8))
+BLOCK_SIZE = 1 << 22
+
+# the features of the annotation kept, and how their lines are matched
+FEATURES = ("gene", "transcript", "exon")
+GTF_RECORD = re.compile(
+    rb"^([^\t#][^\t]*)\t[^\t]*\t(gene|transcript|exon)\t(\d+)\t(\d+)"
+    rb"\t[^\t]*\t([-+.])\t[^\t]*\t(.*)$",
+    re.MULTILINE,
+)
+GTF_ATTRIBUTE = re.compile(rb'(\w+) "([^"]*)"')
+GENE_ID = re.compile(rb'gene_id "([^"]*)"')
+TRANSCRIPT_ID = re.compile(rb'transcript_id "([^"]*)"')
+STRANDS = {b"+": 1, b"-": -1, b".": 0}
+
+GENE_INFO_COLUMNS = [
+    "chrom",
+    "strand",
+    "txStart",
+    "txEnd",
+    "exonCount",
+    "exonStarts",
+    "exonEnds",
+    "transcriptID",
+    "geneID",
+    "geneSymbol",
+    "biotype",
+]
 
 
 class Species(StrEnum):
@@ -13,21 +58,34 @@ class Species(StrEnum):
     CAENORHABDITIS_ELEGANS = "Caenorhabditis_elegans"
 
 
+# species whose assembly is downloaded one chromosome at a time
+CHROMOSOMES = {
+    Species.DROSOPHILA_MELANOGASTER: "2L 2R 3L 3R 4 X Y mitochondrion_genome".split(),
+}
+
+
 @dataclass
 class Genome:
     species: Species
     version: str
     release: str
-    location: Path
+    location: Path = None
+    base_url: str = ENSEMBL_URL
 
     def __post_init__(self):
+        # without a location of its own, the genome is shared through the store
+        self.stored = self.location is None
+
+        if self.stored:
+            self.location = store.location(
+                "genomes", f"{self.species}.{self.version}.{self.release}"
+            )
+            store.use(self.location)
+
         self.location = Path(self.location)
 
-        self.fasta_file = (
-            self.location / f"{self.species}.{self.version}.dna.primary_assembly.fa"
-        )
-        self.gtf_file = (
-            self.location / f"{self.species}.{self.version}.{self.release}.chr.gtf"
+        self.fasta_file, self.gtf_file = genome_files(
+            self.species, self.version, self.release, self.location
         )
 
         if self.species == Species.DROSOPHILA_MELANOGASTER:
@@ -38,35 +96,495 @@ class Genome:
 
         self.files_download = self.download_genome_files()
 
+    @cached_property
+    def fasta(self) -> "Fasta":
+        return Fasta(self.fasta_file)
+
+    def fetch(self, chromosome: str, start: int, end: int) -> str:
+        "Bases start to end (0-based, end excluded) of a chromosome of the downloaded genome"
+
+        return self.fasta.fetch(chromosome, start, end)
+
+    @cached_property
+    def annotation(self) -> "Annotation":
+        return load_annotation(self.gtf_file)
+
+    @cached_property
+    def fasta_index_creation(self) -> worker.Job:
+        "Job that indexes the FASTA file, shared by every step that needs the .fai"
+
+        return worker.execute(
+            f"""
+                if [ -f {self.fasta_file}.fai ]; then exit 0; fi
+                faidx {self.fasta_file}
+            """,
+            job_name="CREATE_GENOME_FASTA_FILE_INDEX",
+            memory=2048,
+            depends_on=[self.files_download],
+            outputs=[f"{self.fasta_file}.fai"],
+        )
+
     def download_genome_files(self):
-        if self.species == Species.DROSOPHILA_MELANOGASTER:
-            command = f"""
-                if [ ! -f '{self.fasta_file}' ]; then
-                    for chromosome in 2L 2R 3L 3R 4 X Y mitochondrion_genome;
-                    do
-                        wget -O {self.species}.{self.version}.dna.primary_assembly.${{chromosome}}.fa.gz http://ftp.ensembl.org/pub/release-{self.release}/fasta/{self.species.lower()}/dna/{self.species}.{self.version}.dna.primary_assembly.${{chromosome}}.fa.gz
-                    done
-                    
-                    mkdir -p {self.location}
-                    zcat {self.species}.{self.version}.dna.primary_assembly.*.fa.gz > {self.fasta_file};
-                fi
-
-                if [ ! -f '{self.gtf_file}' ]; then
-                    wget -P {self.location} http://ftp.ensembl.org/pub/release-{self.release}/gtf/{self.species.lower()}/{self.gtf_file.name}.gz
-                    gunzip {self.gtf_file}.gz;
-                fi
-            """
-        else:
-            command = f"""
-                if [ ! -f '{self.fasta_file}' ]; then
-                    wget -P {self.location} http://ftp.ensembl.org/pub/release-{self.release}/fasta/{self.species.lower()}/dna/{self.fasta_file.name}.gz
-                    gunzip {self.fasta_file}.gz;
-                fi
-
-                if [ ! -f '{self.gtf_file}' ]; then
-                    wget -P {self.location} http://ftp.ensembl.org/pub/release-{self.release}/gtf/{self.species.lower()}/{self.gtf_file.name}.gz
-                    gunzip {self.gtf_file}.gz;
-                fi
-            """
-
-        return worker.execute(command, job_name="DOWNLOAD_GENOME_FILES")
+        command = f"""
+            genome                                  \
+                --species {self.species}            \
+                --version {self.version}            \
+                --release {self.release}            \
+                --location {self.location}          \
+                --base-url {self.base_url}
+        """
+
+        if self.stored:
+            if worker.cache is None and store.is_complete(self.location):
+                return worker.wait([])
+
+            command = store.build_command(self.location, command)
+
+        return worker.execute(
+            command,
+            job_name="DOWNLOAD_GENOME_FILES",
+            vcpu=4,
+            memory=4096,
+            outputs=[self.fasta_file, self.gtf_file],
+            version=f"{self.version}.{self.release}",
+        )
+
+
+def genome_files(
+    species: Species, version: str, release: str, location: Path
+) -> tuple[Path, Path]:
+    return (
+        Path(location) / f"{species}.{version}.dna.primary_assembly.fa",
+        Path(location) / f"{species}.{version}.{release}.chr.gtf",
+    )
+
+
+def fasta_sources(
+    species: Species, version: str, release: str, base_url: str = ENSEMBL_URL
+) -> list[list[str]]:
+    "URLs of the parts of the assembly, in order, each with the files to fall back to"
+
+    prefix = f"{base_url}/release-{release}/fasta/{species.lower()}/dna/{species}.{version}.dna"
+
+    if species in CHROMOSOMES:
+        return [
+            [
+                f"{prefix}.primary_assembly.{chromosome}.fa.gz",
+                f"{prefix}.chromosome.{chromosome}.fa.gz",
+            ]
+            for chromosome in CHROMOSOMES[species]
+        ]
+
+    return [[f"{prefix}.primary_assembly.fa.gz", f"{prefix}.toplevel.fa.gz"]]
+
+
+def gtf_sources(
+    species: Species, version: str, release: str, base_url: str = ENSEMBL_URL
+) -> list[list[str]]:
+    prefix = f"{base_url}/release-{release}/gtf/{species.lower()}/{species}.{version}.{release}"
+    return [[f"{prefix}.chr.gtf.gz", f"{prefix}.gtf.gz"]]
+
+
+def fetch(candidates: list[str], destination: Path) -> Path:
+    "Download the first of the URLs that exists, decompressing it as it arrives"
+
+    for url in candidates:
+        try:
+            with urllib.request.urlopen(url, timeout=60) as response:
+                with open(destination, "wb") as file:
+                    shutil.copyfileobj(gzip.GzipFile(fileobj=response), file, 1 << 20)
+            return destination
+        except urllib.error.HTTPError as error:
+            if error.code != 404:
+                raise
+
+    raise FileNotFoundError(f"None of {', '.join(candidates)} exists")
+
+
+def download(outputs: dict[Path, list[list[str]]], threads: int = DOWNLOAD_THREADS):
+    "Download the parts of every missing output at once, then join each output's parts in order"
+
+    outputs = {
+        output: parts for output, parts in outputs.items() if not output.exists()
+    }
+
+    with ThreadPoolExecutor(threads) as pool:
+        fetches = {
+            output: [
+                pool.submit(
+                    fetch, candidates, output.with_name(f"{output.name}.{index}.part")
+                )
+                for index, candidates in enumerate(parts)
+            ]
+            for output, parts in outputs.items()
+        }
+
+        for output, futures in fetches.items():
+            parts = [future.result() for future in futures]
+
+            # joined under a temporary name, so an output that exists is complete
+            if len(parts) > 1:
+                with open(parts[0], "ab") as file:
+                    for part in parts[1:]:
+                        with open(part, "rb") as source:
+                            shutil.copyfileobj(source, file, 1 << 20)
+                        part.unlink()
+
+            os.replace(parts[0], output)
+
+
+def line_layout(sequence: np.ndarray, line_end: int = 1) -> tuple[int, int, int]:
+    "Number of bases, bases per line and bytes per line of the lines of a sequence, whose lines end in line_end bytes"
+
+    newlines = np.flatnonzero(sequence == ord("\n"))
+    carriage_returns = np.count_nonzero(sequence == ord("\r"))
+
+    # lengths of the lines with their line ends, the last one maybe without
+    widths = np.diff(newlines, prepend=-1)
+    last_line = newlines[-1] + 1 if len(newlines) else 0
+
+    if last_line < len(sequence):
+        widths = np.append(widths, len(sequence) - last_line)
+
+    width = int(widths[0]) if len(widths) else 0
+
+    # like samtools, every line but the last must be as long as the first
+    if np.any(widths[:-1] != width) or np.any(widths[-1:] > width):
+        raise ValueError("Lines of different lengths")
+
+    length = len(sequence) - len(newlines) - carriage_returns
+    line_end = 2 if carriage_returns else line_end
+
+    # like samtools, a single line without its line end is taken to have one
+    if not len(newlines) and length:
+        return length, length, length + line_end
+
+    return length, max(width - line_end, 0), width
+
+
+def index_fasta(fasta: Path, index: Path = None) -> Path:
+    "Write a samtools-compatible .fai of a FASTA file in one pass over its memory map"
+
+    fasta = Path(fasta)
+    index = Path(index or f"{fasta}.fai")
+    entries = []
+
+    # the map closes once nothing refers to it, which an error may put off
+    with open(fasta, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # the bytes of the map, without copying them
+    content = np.frombuffer(data, dtype=np.uint8)
+    header = data.find(b">")
+
+    while header != -1:
+        header_end = data.find(b"\n", header)
+        header_end = len(data) if header_end == -1 else header_end
+        name = data[header + 1 : header_end].split()[0].decode()
+
+        start = min(header_end + 1, len(data))
+        following = data.find(b"\n>", header_end)
+        end = len(data) if following == -1 else following + 1
+
+        # a sequence of one unterminated line ends its lines like its header does
+        line_end = 2 if data[header_end - 1 : header_end] == b"\r" else 1
+
+        try:
+            length, bases, width = line_layout(content[start:end], line_end)
+        except ValueError as error:
+            raise ValueError(f"{error} in {name} of {fasta}")
+
+        entries.append(f"{name}\t{length}\t{start}\t{bases}\t{width}")
+
+        header = following if following == -1 else following + 1
+
+    # named after the process, since several may index the same file at once
+    temporary = index.with_name(f"{index.name}.{os.getpid()}.tmp")
+    temporary.write_text("".join(f"{entry}\n" for entry in entries))
+    os.replace(temporary, index)
+
+    return index
+
+
+class Fasta:
+    "Random access to the sequences of a FASTA file through a memory map and its .fai"
+
+    def __init__(self, fasta: Path, index: Path = None):
+        index = Path(index or f"{fasta}.fai")
+
+        if not index.exists():
+            index_fasta(fasta, index)
+
+        self.index = {}
+
+        for line in index.read_text().splitlines():
+            name, *fields = line.split("\t")
+            self.index[name] = tuple(map(int, fields))
+
+        with open(fasta, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def offset(self, chromosome: str, position: int) -> int:
+        length, offset, bases, width = self.index[chromosome]
+        return offset + position // bases * width + position % bases
+
+    def fetch(self, chromosome: str, start: int, end: int) -> str:
+        "Bases start to end (0-based, end excluded), reading only the lines that hold them"
+
+        length = self.index[chromosome][0]
+        start, end = max(start, 0), min(end, length)
+
+        if start >= end:
+            return ""
+
+        sequence = self.data[
+            self.offset(chromosome, start) : self.offset(chromosome, end)
+        ]
+        return sequence.replace(b"\n", b"").replace(b"\r", b"").decode()
+
+
+@dataclass
+class Annotation:
+    "Genes, transcripts and exons of a GTF file as columns, their names kept once each"
+
+    # one row per feature, from its 0-based start to past its last base
+    feature: np.ndarray
+    chromosome: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+    strand: np.ndarray
+    gene: np.ndarray
+    transcript: np.ndarray
+
+    # names, indexed by the codes of the rows
+    chromosomes: np.ndarray
+    genes: np.ndarray
+    gene_names: np.ndarray
+    biotypes: np.ndarray
+    transcripts: np.ndarray
+
+    def rows(self, feature: str) -> np.ndarray:
+        return np.flatnonzero(self.feature == FEATURES.index(feature))
+
+    def save(self, directory: Path):
+        "Write every column to a .npy file, the directory moved into place once complete"
+
+        temporary = Path(tempfile.mkdtemp(dir=directory.parent, prefix=directory.name))
+        temporary.chmod(0o755)
+
+        for name, column in vars(self).items():
+            np.save(temporary / f"{name}.npy", column)
+
+        try:
+            os.rename(temporary, directory)
+        except OSError:
+            # saved meanwhile by another job
+            shutil.rmtree(temporary)
+
+    @classmethod
+    def load(cls, directory: Path) -> "Annotation":
+        "Columns mapped from their files, so that only what is used is read"
+
+        return cls(
+            **{
+                name: np.load(directory / f"{name}.npy", mmap_mode="r")
+                for name in cls.__dataclass_fields__
+            }
+        )
+
+
+def gtf_records(gtf: Path) -> Iterator[re.Match]:
+    "Genes, transcripts and exons of a GTF file, found a block of lines at a time"
+
+    remainder = b""
+
+    with open(gtf, "rb") as file:
+        while block := file.read(BLOCK_SIZE):
+            block = remainder + block
+            end = block.rfind(b"\n") + 1
+            block, remainder = block[:end], block[end:]
+
+            yield from GTF_RECORD.finditer(block)
+
+    yield from GTF_RECORD.finditer(remainder)
+
+
+def names(codes: dict[bytes, int]) -> np.ndarray:
+    return np.array([name.decode() for name in codes], dtype=str)
+
+
+def parse_gtf(gtf: Path) -> Annotation:
+    "Read a GTF file into columns, coding chromosomes, genes and transcripts as they appear"
+
+    chromosomes, genes, transcripts = {}, {}, {}
+    gene_names, biotypes = [], []
+
+    # typed arrays, which take 8 bytes a value however many rows there are
+    columns = {
+        name: array.array("q")
+        for name in ("feature", "chromosome", "start", "end", "strand")
+        + ("gene", "transcript")
+    }
+
+    for match in gtf_records(gtf):
+        chromosome, feature, start, end, strand, attributes = match.groups()
+        gene_id = GENE_ID.search(attributes)[1]
+        transcript_id = TRANSCRIPT_ID.search(attributes)
+        transcript_id = transcript_id and transcript_id[1]
+
+        # the other attributes are read once for every gene
+        if gene_id not in genes:
+            genes[gene_id] = len(genes)
+            attributes = dict(GTF_ATTRIBUTE.findall(attributes))
+            gene_names.append(attributes.get(b"gene_name", b"").decode())
+
+            # Ensembl names the biotype gene_biotype and GENCODE gene_type
+            biotype = attributes.get(b"gene_biotype", attributes.get(b"gene_type"))
+            biotypes.append((biotype or b"").decode())
+
+        if transcript_id is not None and transcript_id not in transcripts:
+            transcripts[transcript_id] = len(transcripts)
+
+        columns["feature"].append(FEATURES.index(feature.decode()))
+        columns["chromosome"].append(
+            chromosomes.setdefault(chromosome, len(chromosomes))
+        )
+        columns["start"].append(int(start) - 1)
+        columns["end"].append(int(end))
+        columns["strand"].append(STRANDS[strand])
+        columns["gene"].append(genes[gene_id])
+        columns["transcript"].append(transcripts.get(transcript_id, -1))
+
+    columns = {
+        name: np.frombuffer(values, dtype=np.int64) for name, values in columns.items()
+    }
+
+    return Annotation(
+        feature=columns["feature"].astype(np.int8),
+        chromosome=columns["chromosome"].astype(np.int32),
+        start=columns["start"].astype(np.int64),
+        end=columns["end"].astype(np.int64),
+        strand=columns["strand"].astype(np.int8),
+        gene=columns["gene"].astype(np.int32),
+        transcript=columns["transcript"].astype(np.int32),
+        chromosomes=names(chromosomes),
+        genes=names(genes),
+        gene_names=np.array(gene_names, dtype=str),
+        biotypes=np.array(biotypes, dtype=str),
+        transcripts=names(transcripts),
+    )
+
+
+def annotation_cache(gtf: Path) -> Path:
+    return gtf.with_name(f"{gtf.name}.columns")
+
+
+def load_annotation(gtf: Path) -> Annotation:
+    "Columns of a GTF file, parsed once and loaded from their cache next to it after"
+
+    gtf = Path(gtf)
+    cache = annotation_cache(gtf)
+
+    # a cache older than the GTF file is from an earlier download of it
+    if cache.exists() and cache.stat().st_mtime < gtf.stat().st_mtime:
+        shutil.rmtree(cache, ignore_errors=True)
+
+    if not cache.exists():
+        parse_gtf(gtf).save(cache)
+
+    return Annotation.load(cache)
+
+
+def write_gene_info(annotation: Annotation, output: Path):
+    "Write the transcripts and their exons in the gene info format PORT reads"
+
+    exons = annotation.rows("exon")
+    exons = exons[annotation.transcript[exons] >= 0]
+
+    # exons grouped by transcript, in order along the chromosome
+    exons = exons[np.lexsort((annotation.start[exons], annotation.transcript[exons]))]
+    transcripts = annotation.transcript[exons]
+    boundaries = np.flatnonzero(np.diff(transcripts)) + 1
+    firsts = np.concatenate(([0], boundaries))
+    lasts = np.concatenate((boundaries, [len(exons)]))
+
+    strands = {1: "+", -1: "-", 0: "."}
+    starts = annotation.start[exons].tolist()
+    ends = annotation.end[exons].tolist()
+    temporary = output.with_name(f"{output.name}.tmp")
+
+    with open(temporary, "w") as file:
+        print("#" + "\t".join(GENE_INFO_COLUMNS), file=file)
+
+        for first, last in zip(firsts.tolist(), lasts.tolist()):
+            row = exons[first]
+            gene = annotation.gene[row]
+
+            fields = [
+                annotation.chromosomes[annotation.chromosome[row]],
+                strands[int(annotation.strand[row])],
+                min(starts[first:last]),
+                max(ends[first:last]),
+                last - first,
+                "".join(f"{start}," for start in starts[first:last]),
+                "".join(f"{end}," for end in ends[first:last]),
+                annotation.transcripts[transcripts[first]],
+                annotation.genes[gene],
+                annotation.gene_names[gene],
+                annotation.biotypes[gene],
+            ]
+            print("\t".join(map(str, fields)), file=file)
+
+    os.replace(temporary, output)
+
+
+def faidx():
+    parser = argparse.ArgumentParser(
+        description="Index a FASTA file like samtools faidx, without samtools"
+    )
+    parser.add_argument("fasta", type=Path)
+    parser.add_argument("--output", type=Path)
+    arguments = parser.parse_args()
+
+    index_fasta(arguments.fasta, arguments.output)
+
+
+def gtf():
+    parser = argparse.ArgumentParser(
+        description="Parse a GTF file into columns cached next to it"
+    )
+    parser.add_argument("gtf", type=Path)
+    parser.add_argument(
+        "--gene-info", type=Path, help="Also write a PORT gene info file"
+    )
+    arguments = parser.parse_args()
+
+    annotation = load_annotation(arguments.gtf)
+
+    if arguments.gene_info:
+        write_gene_info(annotation, arguments.gene_info)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download the assembly and annotation of a genome from Ensembl"
+    )
+    parser.add_argument("--species", type=Species, choices=list(Species))
+    parser.add_argument("--version")
+    parser.add_argument("--release")
+    parser.add_argument("--location", type=Path)
+    parser.add_argument("--base-url", default=ENSEMBL_URL)
+    parser.add_argument("--threads", type=int, default=DOWNLOAD_THREADS)
+    genome = parser.parse_args()
+
+    genome.location.mkdir(parents=True, exist_ok=True)
+
+    fasta_file, gtf_file = genome_files(
+        genome.species, genome.version, genome.release, genome.location
+    )
+    arguments = (genome.species, genome.version, genome.release, genome.base_url)
+
+    download(
+        {fasta_file: fasta_sources(*arguments), gtf_file: gtf_sources(*arguments)},
+        genome.threads,
+    )
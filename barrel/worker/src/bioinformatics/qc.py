@@ -0,0 +1,118 @@
+import argparse
+import io
+import os
+import statistics
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable
+
+SUMMARY_THREADS = int(os.environ.get("QC_SUMMARY_THREADS", 8))
+
+COLUMNS = [
+    "file",
+    "total_sequences",
+    "sequence_length",
+    "gc_content",
+    "mean_base_quality",
+    "lowest_base_quality",
+    "deduplicated_percentage",
+    "maximum_adapter_content",
+]
+
+
+def modules(lines: Iterable[str]) -> dict[str, tuple[str, list[list[str]]]]:
+    "Status and rows of every module of a fastqc_data.txt, read line by line"
+
+    parsed = {}
+
+    for line in lines:
+        line = line.rstrip("\n")
+
+        if line.startswith(">>") and line != ">>END_MODULE":
+            name, status = line[2:].split("\t")
+            rows = parsed.setdefault(name, (status, []))[1]
+        elif line and line != ">>END_MODULE" and not line.startswith("##"):
+            rows.append(line.split("\t"))
+
+    return parsed
+
+
+def report_data(report: Path) -> dict[str, tuple[str, list[list[str]]]]:
+    "Modules of a FastQC report, streamed out of its zip without unpacking it"
+
+    with zipfile.ZipFile(report) as archive:
+        (name,) = [
+            name for name in archive.namelist() if name.endswith("/fastqc_data.txt")
+        ]
+
+        with archive.open(name) as file:
+            return modules(io.TextIOWrapper(file, encoding="utf-8"))
+
+
+def table(data: dict, module: str) -> list[list[str]]:
+    "Rows of a module, without its column names"
+
+    return [row for row in data.get(module, ("", []))[1] if not row[0].startswith("#")]
+
+
+def formatted(values: list[float], function) -> str:
+    return f"{function(values):.2f}" if values else "nan"
+
+
+def summarize(report: Path) -> dict:
+    data = report_data(report)
+
+    basic = dict(table(data, "Basic Statistics"))
+    base_quality = [float(row[1]) for row in table(data, "Per base sequence quality")]
+    deduplicated = [
+        float(row[1])
+        for row in data.get("Sequence Duplication Levels", ("", []))[1]
+        if row[0] == "#Total Deduplicated Percentage"
+    ]
+    adapter_content = [
+        float(value) for row in table(data, "Adapter Content") for value in row[1:]
+    ]
+
+    summary = {
+        "file": basic["Filename"],
+        "total_sequences": basic["Total Sequences"],
+        "sequence_length": basic["Sequence length"],
+        "gc_content": basic["%GC"],
+        "mean_base_quality": formatted(base_quality, statistics.mean),
+        "lowest_base_quality": formatted(base_quality, min),
+        "deduplicated_percentage": formatted(deduplicated, max),
+        "maximum_adapter_content": formatted(adapter_content, max),
+    }
+
+    # pass, warn or fail for every module
+    summary |= {name: status for name, (status, _) in data.items()}
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarize FastQC reports in one table, one row per FASTQ file"
+    )
+    parser.add_argument("reports", nargs="+", type=Path)
+    parser.add_argument("--output", type=Path, required=True)
+    parser.add_argument("--threads", type=int, default=SUMMARY_THREADS)
+    arguments = parser.parse_args()
+
+    with ThreadPoolExecutor(arguments.threads) as pool:
+        summaries = list(pool.map(summarize, arguments.reports))
+
+    statuses = list(dict.fromkeys(name for summary in summaries for name in summary))
+    columns = COLUMNS + [name for name in statuses if name not in COLUMNS]
+
+    temporary = arguments.output.with_name(f"{arguments.output.name}.tmp")
+
+    with open(temporary, "w") as file:
+        print("\t".join(columns), file=file)
+
+        for summary in summaries:
+            print("\t".join(summary.get(column, "") for column in columns), file=file)
+
+    os.replace(temporary, arguments.output)
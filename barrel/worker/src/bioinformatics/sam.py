@@ -0,0 +1,36 @@
+import argparse
+import os
+import shutil
+
+from pathlib import Path
+
+BLOCK_SIZE = 1 << 22
+
+
+def merge(chunks: list[Path], output: Path):
+    "Join SAM files of chunks of reads, keeping the header of the first"
+
+    temporary = output.with_name(f"{output.name}.part")
+
+    with open(temporary, "wb") as merged:
+        for index, chunk in enumerate(chunks):
+            with open(chunk, "rb") as file:
+                while (line := file.readline()).startswith(b"@"):
+                    if index == 0:
+                        merged.write(line)
+
+                merged.write(line)
+                shutil.copyfileobj(file, merged, BLOCK_SIZE)
+
+    os.replace(temporary, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Work with SAM files")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    merging = subparsers.add_parser("merge", help="Join alignments of chunks of reads")
+    merging.add_argument("chunks", nargs="+", type=Path)
+    merging.add_argument("--output", type=Path, required=True)
+    arguments = parser.parse_args()
+
+    merge(arguments.chunks, arguments.output)
@@ -1,20 +1,33 @@
+import math
 import os
 import worker
 
 from abc import ABC, abstractproperty
+from cache import identity
 from contextlib import suppress
 from dataclasses import dataclass
 from pathlib import Path
 from worker import every, wait
 
+from bioinformatics import fastq, store
 from bioinformatics.data import Read, Sample
 from bioinformatics.genome import Genome, Species
 
+# compressed bytes of reads that each job of a scattered alignment aligns
+SCATTER_CHUNK_SIZE = int(os.environ.get("SCATTER_CHUNK_SIZE", 2**30))
+
+# where tarballs of programs installed in the store are found and published, e.g. s3://bucket/software
+SOFTWARE_PREBUILT = os.environ.get("SOFTWARE_PREBUILT")
+
 
 @dataclass
 class Program(ABC):
     version: str
-    location: Path
+    # without a location of its own, the program is shared through the store
+    location: Path = None
+    build_flags: str = ""
+    # URL of a tarball of the installed program, imported instead of building it
+    prebuilt: str = None
 
     @abstractproperty
     def install_command(self) -> str:
@@ -25,24 +38,68 @@ class Program(ABC):
         pass
 
     def __post_init__(self):
+        name = type(self).__name__
+        self.stored = self.location is None
+
+        if self.stored:
+            self.location = store.location(
+                "software", f"{name}-{self.version}", build_flags=self.build_flags
+            )
+            store.use(self.location)
+
+            if self.prebuilt is None and SOFTWARE_PREBUILT:
+                self.prebuilt = f"{SOFTWARE_PREBUILT}/{self.location.name}.tar.gz"
+
+        self.location = Path(self.location)
         self.installation = self.install()
 
-    def install(self) -> str:
-        command = f"""
-            if [ -d "{self.location}" ]; then exit 0; fi
-            
-            mkdir -p {self.location}
+    def install(self) -> worker.Job:
+        build = self.install_command
+        vcpu, memory = 8, 16000
+
+        if self.prebuilt:
+            tarball = "$TEMPORARY_DIRECTORY/prebuilt.tar.gz"
+            build = f"""
+                transfer --source={self.prebuilt} --destination={tarball} || true
+
+                if [ -f {tarball} ]; then
+                    tar -xzf {tarball} --directory {self.location}
+                else
+                    {build}
+                    references export {self.location} --destination {self.prebuilt} \
+                        || echo "Could not publish {self.prebuilt}"
+                fi
+            """
+
+            # importing the tarball needs none of the resources of building
+            if identity(self.prebuilt) is not None:
+                vcpu, memory = 2, 4096
+
+        command = store.build_command(
+            self.location,
+            f"""
+                set -e
 
-            export TEMPORARY_DIRECTORY=$(mktemp -d)
-            cd $TEMPORARY_DIRECTORY
+                export TEMPORARY_DIRECTORY=$(mktemp -d)
+                trap 'rm -rf $TEMPORARY_DIRECTORY' EXIT
+                cd $TEMPORARY_DIRECTORY
 
-            {self.install_command}
+                {build}
+            """,
+        )
 
-            rm -r $TEMPORARY_DIRECTORY
-        """
+        if worker.cache is None and store.is_complete(self.location):
+            return wait([])
 
-        name = type(self).__name__
-        return worker.execute(command, job_name=f"INSTALL_{name}", vcpu=8, memory=16000)
+        return worker.execute(
+            command,
+            job_name=f"INSTALL_{type(self).__name__}",
+            vcpu=vcpu,
+            memory=memory,
+            # an installation is complete only once marked, however much of it exists
+            outputs=[store.marker(self.location)],
+            version=self.version,
+        )
 
 
 class FASTQC(Program):
@@ -59,35 +116,131 @@ class FASTQC(Program):
     def executable(self):
         return Path(f"{self.location}/fastqc")
 
-    def analyze(self, read: Read, output_directory: Path):
-        if not Path(
+    def report(self, read: Read, output_directory: Path) -> Path:
+        return Path(
             f"{output_directory}/{read.location.name.removesuffix(''.join(read.location.suffixes))}_fastqc.zip"
-        ).exists():
+        )
+
+    def analysis_command(self, read: Read, output_directory: Path) -> str:
+        return f"mkdir -p {output_directory}; {self.executable} -o {output_directory} {read.location}"
+
+    def analyze(self, read: Read, output_directory: Path):
+        report = self.report(read, output_directory)
+
+        if worker.cache is not None or not report.exists():
             worker.execute(
-                f"mkdir -p {output_directory}; {self.executable} -o {output_directory} {read.location}",
+                self.analysis_command(read, output_directory),
                 job_name="QUALITY_ANALYSIS",
                 depends_on=[self.installation, read.download],
+                outputs=[report],
+                inputs=[read.location],
+                version=self.version,
+            )
+
+    def analyze_all(self, reads: list[Read], output_directory: Path):
+        "Analyze every read in one array job, each child waiting only for its own read"
+
+        reads = [
+            read for read in reads if not self.report(read, output_directory).exists()
+        ]
+
+        if reads:
+            return worker.execute_array(
+                [self.analysis_command(read, output_directory) for read in reads],
+                job_name="QUALITY_ANALYSIS",
+                depends_on=[self.installation],
+                each_depends_on=[read.download for read in reads],
             )
 
+    def analyze_grouped(
+        self,
+        reads: list[Read],
+        output_directory: Path,
+        reads_per_job: int = 8,
+        threads: int = 4,
+    ) -> worker.Job:
+        "Analyze the reads a group per job with one FastQC of several threads, then summarize every report in one table"
+
+        pending = [
+            read for read in reads if not self.report(read, output_directory).exists()
+        ]
+        groups = [
+            pending[start : start + reads_per_job]
+            for start in range(0, len(pending), reads_per_job)
+        ]
+
+        analyses = []
+
+        if groups:
+            analyses.append(
+                worker.execute_array(
+                    [
+                        f"mkdir -p {output_directory}; {self.executable} -t {threads} -o {output_directory} "
+                        + " ".join(str(read.location) for read in group)
+                        for group in groups
+                    ],
+                    job_name="QUALITY_ANALYSIS_GROUP",
+                    # FastQC gives each thread 250 MB of Java heap
+                    vcpu=threads,
+                    memory=1024 + 512 * threads,
+                    # the reads are downloaded in bulk jobs that match no group
+                    depends_on=[self.installation]
+                    + every(read.download for read in pending),
+                )
+            )
+
+        reports = " ".join(str(self.report(read, output_directory)) for read in reads)
+
+        return worker.execute(
+            f"qc {reports} --output {output_directory}/summary.tsv",
+            job_name="QUALITY_SUMMARY",
+            depends_on=analyses,
+            outputs=[output_directory / "summary.tsv"],
+            inputs=[self.report(read, output_directory) for read in reads],
+        )
 
+
+@dataclass
 class STAR(Program):
+    # compresses alignments to BAM or CRAM as STAR writes them
+    samtools: "SAMTOOLS" = None
+    # genome whose FASTA file CRAM alignments are compressed against
+    reference: Genome = None
+
+    def __post_init__(self):
+        super().__post_init__()
+
+        if self.samtools is not None:
+            self.installation = wait([self.installation, self.samtools.installation])
+
     @property
     def install_command(self):
         return f"""
             wget https://github.com/alexdobin/STAR/archive/{self.version}.tar.gz
             tar -xzf {self.version}.tar.gz --strip-components 1 --directory {self.location}
             cd {self.location}/source
-            make -j STAR
+            make -j STAR {self.build_flags}
         """
 
     @property
     def executable(self):
         return self.location / "source" / "STAR"
 
-    def create_index(self, genome: Genome):
-        self.index_location = Path(
-            f"{genome.location}/{genome.species}.{genome.version}.{genome.release}.index"
-        )
+    def create_index(self, genome: Genome, sjdb_overhang: int = 99):
+        name = f"{genome.species}.{genome.version}.{genome.release}"
+
+        # the index of a shared genome is shared too
+        if genome.stored:
+            self.index_location = store.location(
+                "star",
+                name,
+                genome=genome.location.name,
+                version=self.version,
+                sjdb_overhang=sjdb_overhang,
+            )
+            store.use(self.index_location)
+        else:
+            self.index_location = Path(f"{genome.location}/{name}.index")
 
         create_index_command = f"""
             mkdir -p {self.index_location}
@@ -99,12 +252,21 @@ class STAR(Program):
                 --genomeDir {self.index_location}               \
                 --genomeFastaFiles {genome.fasta_file}          \
                 --sjdbGTFfile {genome.gtf_file}                 \
-                --sjdbOverhang 99
+                --sjdbOverhang {sjdb_overhang}
         """
 
         dependencies = [self.installation, genome.files_download]
 
-        if self.index_location.exists():
+        if genome.stored:
+            create_index_command = store.build_command(
+                self.index_location, create_index_command
+            )
+
+        if worker.cache is None and (
+            store.is_complete(self.index_location)
+            if genome.stored
+            else self.index_location.exists()
+        ):
             self.index_creation = wait(dependencies)
         else:
             self.index_creation = worker.execute(
@@ -113,51 +275,370 @@ class STAR(Program):
                 vcpu=16,
                 memory=104448,
                 depends_on=dependencies,
+                # a shared index is complete only once marked, however much of it exists
+                outputs=[
+                    (
+                        store.marker(self.index_location)
+                        if genome.stored
+                        else self.index_location
+                    )
+                ],
+                inputs=[genome.fasta_file, genome.gtf_file],
+                version=self.version,
             )
 
-    def align(self, sample: Sample, output: Path):
-        additional_options = []
+    @property
+    def dependencies(self) -> list[worker.Job]:
+        "Jobs every alignment waits for, besides the downloads of its reads"
+
+        dependencies = [self.installation, self.index_creation]
+
+        if self.reference is not None:
+            dependencies.append(self.reference.fasta_index_creation)
+
+        return dependencies
+
+    def streaming_commands(self, sample: Sample) -> tuple[str, str, str]:
+        "Commands that stream the reads into named pipes, that clean up after them, and that check the streams ended well"
 
-        if any(read.location.name.endswith(".gz") for read in sample.reads):
+        commands = ["STREAMS=$(mktemp -d)"]
+
+        for index, read in enumerate(sample.reads):
+            decompress = "--decompress" if read.source.endswith(".gz") else ""
+            commands += [
+                f"mkfifo $STREAMS/{index}",
+                f"transfer --stream --source={read.source} --concurrency 8 --part-size {8 * 2**20} {decompress} > $STREAMS/{index} &",
+                f"STREAM_{index}=$!",
+            ]
+
+        streams = [f"$STREAM_{index}" for index in range(len(sample.reads))]
+        cleanup = f"kill {' '.join(streams)} 2> /dev/null; rm -rf $STREAMS"
+
+        # a stream that failed has cut the reads short
+        check = " && ".join(["[ $? -eq 0 ]"] + [f"wait {stream}" for stream in streams])
+
+        return "\n".join(commands), cleanup, f"{check} || exit 1"
+
+    def compression_commands(
+        self, output: Path, written: str, threads: int
+    ) -> tuple[str, str]:
+        "Commands that open and close a group piping the SAM STAR writes into samtools"
+
+        if output.suffix == ".cram":
+            if self.reference is None:
+                raise ValueError("CRAM alignments need a reference genome")
+
+            # indexed beforehand by the job the alignments depend on
+            options = f"--cram --reference {self.reference.fasta_file}"
+        else:
+            options = "--bam"
+
+        # the status of STAR is kept, since the status of the pipeline is that of samtools
+        opening = "COMPRESSION=$(mktemp -d)\n{"
+        closing = f"""
+            echo $? > $COMPRESSION/status
+            }} | {self.samtools.executable} view {options} --threads {max(threads // 3, 1)} -o {written} -
+        """
+
+        return opening, closing
+
+    def alignment_command(
+        self,
+        sample: Sample,
+        output: Path,
+        threads: int = 6,
+        genome_load: str = "NoSharedMemory",
+    ) -> str:
+        additional_options = []
+        read_files = " ".join(str(read.location) for read in sample.reads)
+        streaming, cleanups, checks = "", [], []
+
+        if any(read.stream for read in sample.reads):
+            if not all(read.stream for read in sample.reads):
+                raise ValueError(f"Reads of {sample.id} are partly streamed")
+
+            streaming, cleanup, check = self.streaming_commands(sample)
+            cleanups.append(cleanup)
+            checks.append(check)
+            read_files = " ".join(
+                f"$STREAMS/{index}" for index in range(len(sample.reads))
+            )
+        elif any(read.location.name.endswith(".gz") for read in sample.reads):
             additional_options.append("--readFilesCommand zcat")
 
-        if output.suffix == ".bam":
+        # compressed as STAR writes it, or by STAR's own BAM output without samtools
+        compressing, compressed = "", ""
+        written = f"{output}Aligned.out{output.suffix}"
+
+        if output.suffix in (".bam", ".cram") and self.samtools is not None:
+            written = f"{output}.part"
+            compressing, compressed = self.compression_commands(
+                output, written, threads
+            )
+            additional_options.append("--outStd SAM")
+            cleanups.append("rm -rf $COMPRESSION")
+            checks.insert(
+                0, '[ $? -eq 0 ] && [ "$(cat $COMPRESSION/status)" -eq 0 ] || exit 1'
+            )
+        elif output.suffix == ".bam":
             additional_options.append("--outSAMtype BAM Unsorted")
+        elif output.suffix != ".sam":
+            raise ValueError(f"{output.suffix} alignments need samtools")
+
+        if genome_load != "NoSharedMemory":
+            additional_options.append(f"--genomeLoad {genome_load}")
+
+        # one trap for everything, since each trap on EXIT replaces the one before
+        trap = f"trap '{'; '.join(cleanups)}' EXIT" if cleanups else ""
+        check = "\n".join(checks)
 
-        command = f"""
+        return f"""
             mkdir -p {output.parent}
+            {streaming}
+            {trap}
+            {compressing}
 
             {self.executable}                                                               \
                 --outFileNamePrefix {output}                                                \
                 --genomeDir {self.index_location}                                           \
                 --runMode alignReads                                                        \
-                --runThreadN 6                                                              \
+                --runThreadN {threads}                                                      \
                 --outSAMunmapped Within KeepPairs                                           \
                 --runRNGseed 42                                                             \
                 --outSAMtype SAM                                                            \
-                --readFilesIn {" ".join(str(read.location) for read in sample.reads)}       \
+                --readFilesIn {read_files}                                                  \
                 {" ".join(additional_options)}
+            {compressed}
+            {check}
 
-            mv {output}Aligned.out{output.suffix} {output}
+            mv {written} {output}
         """
 
-        dependencies = [self.installation, self.index_creation] + [
-            read.download for read in sample.reads
-        ]
+    def align(self, sample: Sample, output: Path):
+        dependencies = self.dependencies + [read.download for read in sample.reads]
 
         sample.alignment = output
 
-        if output.exists():
+        if worker.cache is None and output.exists():
             sample.aligning = wait(dependencies)
         else:
             sample.aligning = worker.execute(
-                command,
+                self.alignment_command(sample, output),
                 job_name="ALIGN",
                 vcpu=6,
                 memory=40960,
                 depends_on=dependencies,
+                outputs=[output],
+                inputs=[
+                    read.source if read.stream else read.location
+                    for read in sample.reads
+                ]
+                + [self.index_location],
+                version=self.version,
             )
 
+    def align_all(self, samples: list[Sample], outputs: list[Path]):
+        "Align every sample in one array job; each sample's aligning handle is its child"
+
+        pending = []
+
+        for sample, output in zip(samples, outputs):
+            sample.alignment = output
+
+            if worker.cache is None and output.exists():
+                sample.aligning = wait(
+                    self.dependencies + [read.download for read in sample.reads]
+                )
+            else:
+                pending.append(sample)
+
+        if not pending:
+            return
+
+        # the reads are downloaded in bulk jobs that match no sample, so the array waits for all of them
+        array = worker.execute_array(
+            [self.alignment_command(sample, sample.alignment) for sample in pending],
+            job_name="ALIGN",
+            vcpu=6,
+            memory=40960,
+            depends_on=self.dependencies
+            + every(read.download for sample in pending for read in sample.reads),
+            outputs=[[sample.alignment] for sample in pending],
+            inputs=[
+                [read.source if read.stream else read.location for read in sample.reads]
+                + [self.index_location]
+                for sample in pending
+            ],
+            version=self.version,
+        )
+
+        for index, sample in enumerate(pending):
+            sample.aligning = worker.child(array, index)
+
+    def grouped_alignment_command(
+        self, samples: list[Sample], concurrent: int, threads: int
+    ) -> str:
+        "Command that loads the index into shared memory once and aligns every sample against it"
+
+        genome = f"--genomeDir {self.index_location} --outFileNamePrefix $GENOME_LOAD/"
+
+        commands = [
+            "GENOME_LOAD=$(mktemp -d)",
+            f"{self.executable} {genome} --genomeLoad LoadAndExit || exit 1",
+            # the index is removed from shared memory however the alignments end
+            f"trap '{self.executable} {genome} --genomeLoad Remove > /dev/null; rm -rf $GENOME_LOAD' EXIT",
+        ]
+
+        for start in range(0, len(samples), concurrent):
+            wave = samples[start : start + concurrent]
+
+            for index, sample in enumerate(wave):
+                alignment = self.alignment_command(
+                    sample, sample.alignment, threads, genome_load="LoadAndKeep"
+                )
+                commands += [f"( {alignment} ) &", f"ALIGNMENT_{index}=$!"]
+
+            commands += ["FAILED=0"]
+            commands += [
+                f"wait $ALIGNMENT_{index} || FAILED=1" for index in range(len(wave))
+            ]
+            commands += ["[ $FAILED -eq 0 ] || exit 1"]
+
+        return "\n".join(commands)
+
+    def align_grouped(
+        self,
+        samples: list[Sample],
+        outputs: list[Path],
+        samples_per_job: int = 4,
+        concurrent: int = 2,
+        vcpu: int = 12,
+        memory: int = 65536,
+    ):
+        "Align samples in groups, each group in one job that loads the index only once"
+
+        pending = []
+
+        for sample, output in zip(samples, outputs):
+            sample.alignment = output
+
+            if worker.cache is None and output.exists():
+                sample.aligning = wait(
+                    self.dependencies + [read.download for read in sample.reads]
+                )
+            else:
+                pending.append(sample)
+
+        if not pending:
+            return
+
+        groups = [
+            pending[start : start + samples_per_job]
+            for start in range(0, len(pending), samples_per_job)
+        ]
+
+        array = worker.execute_array(
+            [
+                self.grouped_alignment_command(group, concurrent, vcpu // concurrent)
+                for group in groups
+            ],
+            job_name="ALIGN_GROUP",
+            vcpu=vcpu,
+            memory=memory,
+            # the reads are downloaded in bulk jobs that match no group
+            depends_on=self.dependencies
+            + every(read.download for sample in pending for read in sample.reads),
+            outputs=[[sample.alignment for sample in group] for group in groups],
+            inputs=[
+                [
+                    read.source if read.stream else read.location
+                    for sample in group
+                    for read in sample.reads
+                ]
+                + [self.index_location]
+                for group in groups
+            ],
+            version=self.version,
+        )
+
+        # every sample of a group is aligned once the group's job is done
+        for index, group in enumerate(groups):
+            for sample in group:
+                sample.aligning = worker.child(array, index)
+
+    def align_scattered(self, sample: Sample, output: Path, chunks: int = None):
+        "Align a large sample as chunks in parallel jobs, then join their alignments into one"
+
+        if any(read.stream for read in sample.reads):
+            raise ValueError("Scattered alignments split the reads, which streams lack")
+
+        if output.suffix != ".sam":
+            raise ValueError("Only SAM alignments of chunks can be joined")
+
+        dependencies = self.dependencies + [read.download for read in sample.reads]
+
+        sample.alignment = output
+
+        if output.exists():
+            sample.aligning = wait(dependencies)
+            return
+
+        if chunks is None:
+            size = sum(
+                (identity(read.location) or identity(read.source) or [None, 0])[1]
+                for read in sample.reads
+            )
+            chunks = max(1, math.ceil(size / SCATTER_CHUNK_SIZE))
+
+        mates = [read.location for read in sample.reads]
+        directory = output.with_name(f"{output.name}.chunks")
+        chunk_files = fastq.chunk_files(mates, directory, chunks)
+
+        splitting = worker.execute(
+            f"""
+                fastq split {" ".join(map(str, mates))} \
+                    --chunks {chunks}                  \
+                    --directory {directory}
+            """,
+            job_name="SPLIT_READS",
+            vcpu=2,
+            memory=4096,
+            depends_on=[read.download for read in sample.reads],
+            outputs=[file for files in chunk_files for file in files],
+            inputs=mates,
+        )
+
+        pieces = [
+            Sample(
+                id=f"{sample.id}.{index}",
+                reads=[
+                    Read(f"file://{files[index]}", files[index], download=splitting)
+                    for files in chunk_files
+                ],
+                alignment=directory / f"{index}.sam",
+            )
+            for index in range(chunks)
+        ]
+
+        alignment = worker.execute_array(
+            [self.alignment_command(piece, piece.alignment) for piece in pieces],
+            job_name="ALIGN_CHUNK",
+            vcpu=6,
+            memory=40960,
+            depends_on=[self.installation, self.index_creation, splitting],
+        )
+
+        # chunks are joined one after another, each keeping the records of a read together, then removed
+        sample.aligning = worker.execute(
+            f"""
+                sam merge {" ".join(str(piece.alignment) for piece in pieces)} \
+                    --output {output} && rm -r {directory}
+            """,
+            job_name="MERGE_ALIGNMENTS",
+            depends_on=[alignment],
+            outputs=[output],
+        )
+
 
 class SAMTOOLS(Program):
     @property
@@ -168,7 +649,7 @@ class SAMTOOLS(Program):
 
             cd samtools-{self.version}
             autoreconf
-            ./configure --prefix={self.location}
+            ./configure --prefix={self.location} {self.build_flags}
             make
             make install
         """
@@ -186,7 +667,7 @@ class SAM2COV(Program):
             tar -xzf v{self.version}.tar.gz --strip-components 1 --directory {self.location}
 
             cd {self.location}
-            make
+            make {self.build_flags}
         """
 
     @property
@@ -219,7 +700,15 @@ class PORT(Program):
         samples_list: str = "sample_directories.txt",
         unaligned_files_list: str = "unaligned_files.loc",
         configuration_file_name: str = "PORT.cfg",
-    ) -> str:
+        lsf_mode: str = "batch",
+        vcpu: int = 1,
+        memory: int = 2048,
+    ) -> worker.Job:
+        "Run PORT, whose jobs are submitted to Batch or, in local LSF mode, packed into this job"
+
+        if any(read.stream for sample in samples for read in sample.reads):
+            raise ValueError("PORT reads the FASTQ files, which streamed reads lack")
+
         location.mkdir(exist_ok=True)
 
         # create list of samples
@@ -228,14 +717,24 @@ class PORT(Program):
                 print(sample.id, file=samples_file)
 
         # create links to aligned and FASTQ files as well as the list of unaligned files
+        compressed = []
+
         with open(f"{location}/{unaligned_files_list}", "w") as unaligned_file:
             for sample in samples:
                 link_directory = f"{location}/reads/{sample.id}"
 
                 os.makedirs(link_directory, exist_ok=True)
 
-                with suppress(FileExistsError):
-                    os.symlink(sample.alignment, f"{link_directory}/Aligned.out.sam")
+                # PORT reads SAM, which compressed alignments are decoded into below
+                if sample.alignment.suffix == ".sam":
+                    with suppress(FileExistsError):
+                        os.symlink(
+                            sample.alignment, f"{link_directory}/Aligned.out.sam"
+                        )
+                else:
+                    compressed.append(
+                        (sample, Path(f"{link_directory}/Aligned.out.sam"))
+                    )
 
                 for read in sample.reads:
                     print(f"{link_directory}/{read.location.name}", file=unaligned_file)
@@ -244,26 +743,54 @@ class PORT(Program):
                             read.location, f"{link_directory}/{read.location.name}"
                         )
 
+        # decode compressed alignments, which PORT's jobs read several times each
+        pending = [
+            (sample, alignment)
+            for sample, alignment in compressed
+            if not alignment.exists()
+        ]
+        decoding = []
+
+        # only CRAM is decoded against the genome
+        def reference(sample: Sample) -> str:
+            if sample.alignment.suffix == ".cram":
+                return f"--reference {genome.fasta_file}"
+            return ""
+
+        if pending:
+            decoding.append(
+                worker.execute_array(
+                    [
+                        f"{samtools.executable} view --with-header --threads 2 {reference(sample)} "
+                        f"-o {alignment}.part {sample.alignment} && mv {alignment}.part {alignment}"
+                        for sample, alignment in pending
+                    ],
+                    job_name="DECODE_ALIGNMENTS",
+                    vcpu=2,
+                    memory=2048,
+                    depends_on=[samtools.installation]
+                    + (
+                        [genome.fasta_index_creation]
+                        if any(reference(sample) for sample, _ in pending)
+                        else []
+                    ),
+                    each_depends_on=[sample.aligning for sample, _ in pending],
+                )
+            )
+
         # create index for genome FASTA file
-        genome_fasta_file_index_creation = worker.execute(
-            f"""
-                if [ -f {genome.fasta_file}.fai ]; then exit 0; fi
-                {samtools.executable} faidx -o {genome.fasta_file}.fai {genome.fasta_file};
-            """,
-            job_name="CREATE_GENOME_FASTA_FILE_INDEX",
-            memory=10000,
-            depends_on=[samtools.installation, genome.files_download],
-        )
+        genome_fasta_file_index_creation = genome.fasta_index_creation
 
         # create genome info file
         genome_info_file = f"{genome.location}/{genome.species}.{genome.version}.{genome.release}.annotation.txt"
         genome_info_file_creation = worker.execute(
             f"""
                 if [ -f {genome_info_file} ]; then exit 0; fi
-                perl {self.location}/norm_scripts/convert_gtf_to_PORT_geneinfo.transcripts.pl {genome.gtf_file} {genome_info_file}
+                gtf {genome.gtf_file} --gene-info {genome_info_file}
             """,
             job_name="CREATE_GENOME_INFO_FILE",
-            depends_on=[self.installation, genome.files_download],
+            depends_on=[genome.files_download],
+            outputs=[genome_info_file],
         )
 
         ribosomal_rna_fasta_file = {
@@ -314,9 +841,17 @@ class PORT(Program):
         if second_part:
             command += f" -part2"
 
+        # the decoded alignments are only kept until the normalization succeeds
+        if compressed:
+            command += (
+                f" && rm -f {' '.join(str(alignment) for _, alignment in compressed)}"
+            )
+
         return worker.execute(
-            command,
+            f"export LSF_MODE={lsf_mode}; {command}",
             job_name="NORMALIZE",
+            vcpu=vcpu,
+            memory=memory,
             depends_on=[
                 self.installation,
                 samtools.installation,
@@ -325,5 +860,6 @@ class PORT(Program):
                 genome_fasta_file_index_creation,
                 genome_info_file_creation,
             ]
+            + decoding
             + every(sample.aligning for sample in samples),
         )
@@ -0,0 +1,161 @@
+import argparse
+import fcntl
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+from cache import digest, s3
+from pathlib import Path
+from urllib.parse import urlparse
+
+# references shared by every analysis, each built once under a lock
+STORE_DIRECTORY = Path(
+    os.environ.get(
+        "REFERENCE_STORE", f"{os.environ['FILE_SYSTEM_MOUNT_POINT']}/references"
+    )
+)
+# references unused for longer than this many days are evicted
+MAX_AGE = float(os.environ.get("REFERENCE_MAX_AGE", 90))
+
+
+def location(kind: str, name: str, **parameters) -> Path:
+    "Directory of a reference, named after everything that determines its content"
+
+    key = digest([kind, name, sorted(parameters.items())])[:16]
+    return STORE_DIRECTORY / kind / f"{name}-{key}"
+
+
+def marker(reference: Path) -> Path:
+    return reference.with_name(f"{reference.name}.complete")
+
+
+def lock(reference: Path) -> Path:
+    return reference.with_name(f"{reference.name}.lock")
+
+
+def is_complete(reference: Path) -> bool:
+    return marker(reference).exists()
+
+
+def use(reference: Path):
+    "Note that an analysis uses the reference, which keeps it from being evicted"
+
+    # the lock keeps the time, since the marker stands for the reference in the step cache
+    if is_complete(reference):
+        os.utime(lock(reference))
+
+
+def build_command(reference: Path, command: str) -> str:
+    "Command that builds a reference unless it is complete, while others wait for it"
+
+    # a directory without its marker is left from a build that failed
+    return f"""
+        mkdir -p {reference.parent}
+        exec 9> {lock(reference)}
+        flock 9
+
+        if [ -f {marker(reference)} ]; then exit 0; fi
+
+        rm -rf {reference}
+        mkdir -p {reference}
+
+        # tested apart, since a tested subshell would ignore set -e
+        ( {command} )
+        [ $? -eq 0 ] || exit 1
+
+        touch {marker(reference)}
+    """
+
+
+def evict(max_age: float = MAX_AGE) -> list[Path]:
+    "Remove references unused for longer than max_age days, except those being built"
+
+    evicted = []
+    cutoff = time.time() - max_age * 86400
+
+    for lock_file in STORE_DIRECTORY.glob("*/*.lock"):
+        reference = lock_file.with_suffix("")
+
+        if not reference.exists():
+            continue
+
+        # the lock is touched by every build and every use
+        if lock_file.stat().st_mtime > cutoff:
+            continue
+
+        with open(lock_file, "w") as file:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+
+            # unmarked first, so the reference is never taken as complete while removed;
+            # the lock stays, since a build may be waiting on it
+            marker(reference).unlink(missing_ok=True)
+            shutil.rmtree(reference, ignore_errors=True)
+
+        evicted.append(reference)
+
+    return evicted
+
+
+def export(reference: Path, destination: str):
+    "Pack a reference into a tarball at an S3 or file URL, for other stores to import"
+
+    if not reference.is_dir():
+        raise FileNotFoundError(reference)
+
+    uri = urlparse(destination)
+
+    with tempfile.TemporaryDirectory() as directory:
+        tarball = Path(directory) / "reference.tar.gz"
+
+        with tarfile.open(tarball, "w:gz", compresslevel=6) as file:
+            file.add(reference, arcname=".")
+
+        if uri.scheme == "s3":
+            s3().upload_file(str(tarball), uri.netloc, uri.path[1:])
+        elif uri.scheme == "file":
+            Path(uri.path).parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(tarball, uri.path)
+        else:
+            raise NotImplementedError
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the shared reference store")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    subparsers.add_parser("list", help="List references and when they were last used")
+    eviction = subparsers.add_parser("evict", help="Remove references unused lately")
+    eviction.add_argument(
+        "--max-age", type=float, default=MAX_AGE, help="Days since last use"
+    )
+    exporting = subparsers.add_parser("export", help="Pack a reference in a tarball")
+    exporting.add_argument("reference", type=Path)
+    exporting.add_argument("--destination", required=True, help="S3 or file URL")
+    arguments = parser.parse_args()
+
+    if arguments.action == "evict":
+        for reference in evict(arguments.max_age):
+            print(f"Evicted {reference}")
+        return
+
+    if arguments.action == "export":
+        return export(arguments.reference, arguments.destination)
+
+    for lock_file in sorted(STORE_DIRECTORY.glob("*/*.lock")):
+        reference = lock_file.with_suffix("")
+
+        if not reference.exists():
+            continue
+
+        if is_complete(reference):
+            last_used = time.strftime(
+                "%Y-%m-%d %H:%M", time.localtime(lock_file.stat().st_mtime)
+            )
+        else:
+            last_used = "incomplete"
+
+        print(f"{reference.relative_to(STORE_DIRECTORY)}\t{last_used}")
@@ -0,0 +1,113 @@
+import boto3
+import hashlib
+import json
+import os
+import tempfile
+
+from botocore.exceptions import ClientError
+from functools import cache
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
+
+
+@cache
+def s3():
+    return boto3.client("s3")
+
+
+def identity(location: str | Path) -> Optional[list]:
+    "Cheap identity of a file, directory or S3 object that changes when its content does"
+
+    location = str(location)
+    uri = urlparse(location)
+
+    if uri.scheme == "s3":
+        try:
+            head = s3().head_object(Bucket=uri.netloc, Key=uri.path[1:])
+        except ClientError:
+            return None
+        return [location, head["ContentLength"], head["ETag"]]
+
+    path = Path(uri.path if uri.scheme == "file" else location)
+
+    if path.is_dir():
+        return [
+            [str(file.relative_to(path)), file.stat().st_size, file.stat().st_mtime_ns]
+            for file in sorted(path.rglob("*"))
+            if file.is_file()
+        ]
+
+    if path.exists():
+        return [str(path), path.stat().st_size, path.stat().st_mtime_ns]
+
+    return None
+
+
+def digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, default=str).encode()).hexdigest()
+
+
+class Cache:
+    "Manifest of completed steps, keyed by their command, tool version, resources and inputs"
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        # jobs that stand for steps found in the cache
+        self.hits = set()
+
+    def key(self, step: dict) -> Optional[str]:
+        identities = [identity(input) for input in step["inputs"]]
+
+        if any(input_identity is None for input_identity in identities):
+            return None
+
+        return digest([step["seed"], identities])
+
+    def lookup(self, step: dict) -> bool:
+        key = self.key(step)
+
+        if key is None:
+            return False
+
+        manifest = self.directory / f"{key}.json"
+
+        if not manifest.exists():
+            return False
+
+        outputs = json.loads(manifest.read_text())["outputs"]
+
+        return all(identity(output) == recorded for output, recorded in outputs)
+
+    def record(self, step: dict, key: str):
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        manifest = {
+            "key": key,
+            "command": step["command"],
+            "outputs": [[output, identity(output)] for output in step["outputs"]],
+        }
+
+        # write then rename, so a manifest is never read half written
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.directory, suffix=".tmp", delete=False
+        ) as file:
+            json.dump(manifest, file)
+
+        os.replace(file.name, self.directory / f"{key}.json")
+
+
+def describe_step(
+    command: str,
+    version: str,
+    vcpu: int,
+    memory: int,
+    inputs: list,
+    outputs: list,
+) -> dict:
+    return {
+        "command": command,
+        "seed": digest([command, version, vcpu, memory]),
+        "inputs": list(map(str, inputs)),
+        "outputs": list(map(str, outputs)),
+    }
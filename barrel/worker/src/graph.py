@@ -0,0 +1,237 @@
+import json
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+
+@dataclass(eq=False)
+class Node:
+    job_name: str
+    command: Optional[str] = None
+    commands: Optional[list[str]] = None
+    vcpu: int = 1
+    memory: int = 2048
+    depends_on: list = field(default_factory=list)
+    each_depends_on: list = field(default_factory=list)
+    retry_attempts: int = 1
+    job_queue: str = None
+    outputs: list[Path] = field(default_factory=list)
+    inputs: list = field(default_factory=list)
+    version: Optional[str] = None
+
+    @property
+    def is_barrier(self) -> bool:
+        return self.command is None and self.commands is None
+
+    @property
+    def dependencies(self) -> list:
+        return self.depends_on + self.each_depends_on
+
+    def key(self) -> tuple:
+        return (
+            self.command,
+            tuple(self.commands or ()),
+            self.vcpu,
+            self.memory,
+            self.retry_attempts,
+            self.job_queue,
+            self.version,
+            tuple(map(str, self.inputs)),
+            tuple(self.depends_on),
+            tuple(self.each_depends_on),
+        )
+
+    def is_complete(self) -> bool:
+        # the outputs of an array are listed child by child
+        outputs = (
+            [output for child in self.outputs for output in child]
+            if self.commands is not None
+            else self.outputs
+        )
+
+        return bool(outputs) and all(Path(output).exists() for output in outputs)
+
+
+@dataclass(frozen=True)
+class Child:
+    node: Node
+    index: int
+
+
+class Graph:
+    "Records jobs instead of submitting them, so they can be deduplicated, pruned and submitted together"
+
+    def __init__(self):
+        self.nodes: dict[tuple, Node] = {}
+        self.jobs: dict[Node, object] = {}
+        self.pruned: set[Node] = set()
+
+    def add(self, node: Node) -> Node:
+        "Record a node, or return the already recorded node doing the same work"
+
+        return self.nodes.setdefault(node.key(), node)
+
+    def levels(self) -> list[list[Node]]:
+        "Group nodes so that each depends only on nodes of earlier groups"
+
+        level = {}
+
+        # nodes are recorded after all of their dependencies
+        for node in self.nodes.values():
+            level[node] = 1 + max(
+                (
+                    level[upstream]
+                    for upstream in map(self.upstream, node.dependencies)
+                    if upstream is not None
+                ),
+                default=-1,
+            )
+
+        levels = [[] for _ in range(max(level.values(), default=-1) + 1)]
+
+        for node, index in level.items():
+            levels[index].append(node)
+
+        return levels
+
+    def upstream(self, dependency) -> Optional[Node]:
+        if isinstance(dependency, Child):
+            return dependency.node
+        if isinstance(dependency, Node):
+            return dependency
+        return None
+
+    def run(self) -> dict:
+        "Submit every node that is not complete, level by level, and return their jobs"
+
+        import worker
+
+        recording, worker.graph = worker.graph, None
+
+        try:
+            for level in self.levels():
+                for node in level:
+                    # steps known to the cache are left for it to decide
+                    cached = worker.cache is not None and node.version is not None
+
+                    if node.is_complete() and not cached:
+                        self.pruned.add(node)
+                        continue
+
+                    depends_on = self.resolve(node.depends_on)
+
+                    if node.is_barrier:
+                        self.jobs[node] = worker.wait(depends_on)
+                    elif node.commands is not None:
+                        self.jobs[node] = worker.execute_array(
+                            node.commands,
+                            node.job_name,
+                            vcpu=node.vcpu,
+                            memory=node.memory,
+                            depends_on=depends_on,
+                            each_depends_on=self.resolve(node.each_depends_on),
+                            retry_attempts=node.retry_attempts,
+                            job_queue=node.job_queue,
+                            outputs=node.outputs,
+                            inputs=node.inputs,
+                            version=node.version,
+                        )
+                    else:
+                        self.jobs[node] = worker.execute(
+                            node.command,
+                            node.job_name,
+                            vcpu=node.vcpu,
+                            memory=node.memory,
+                            depends_on=depends_on,
+                            retry_attempts=node.retry_attempts,
+                            job_queue=node.job_queue,
+                            outputs=node.outputs,
+                            inputs=node.inputs,
+                            version=node.version,
+                        )
+        finally:
+            worker.graph = recording
+
+        return self.jobs
+
+    def resolve(self, dependencies: list) -> list:
+        import worker
+
+        jobs = []
+
+        for dependency in dependencies:
+            # complete nodes were not submitted and need not be waited for
+            if isinstance(dependency, Child):
+                if dependency.node not in self.pruned:
+                    jobs.append(
+                        worker.child(self.jobs[dependency.node], dependency.index)
+                    )
+            elif isinstance(dependency, Node):
+                if dependency not in self.pruned:
+                    jobs.append(self.jobs[dependency])
+            else:
+                jobs.append(dependency)
+
+        return jobs
+
+    def export(self, path: Path):
+        "Write the graph as Graphviz DOT or, for a .json path, as JSON"
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        if path.suffix == ".json":
+            path.write_text(json.dumps(self.to_json(), indent=4))
+        else:
+            path.write_text(self.to_dot())
+
+    def to_json(self) -> list[dict]:
+        identifiers = {node: index for index, node in enumerate(self.nodes.values())}
+
+        def reference(dependency):
+            if isinstance(dependency, Child):
+                return {"node": identifiers[dependency.node], "index": dependency.index}
+            if isinstance(dependency, Node):
+                return {"node": identifiers[dependency]}
+            return {"job": str(dependency)}
+
+        return [
+            {
+                "id": identifiers[node],
+                "job_name": node.job_name,
+                "command": node.command,
+                "commands": node.commands,
+                "vcpu": node.vcpu,
+                "memory": node.memory,
+                "retry_attempts": node.retry_attempts,
+                "depends_on": list(map(reference, node.depends_on)),
+                "each_depends_on": list(map(reference, node.each_depends_on)),
+                "outputs": list(map(str, node.outputs)),
+                "inputs": list(map(str, node.inputs)),
+                "version": node.version,
+                "complete": node.is_complete(),
+            }
+            for node in self.nodes.values()
+        ]
+
+    def to_dot(self) -> str:
+        identifiers = {node: index for index, node in enumerate(self.nodes.values())}
+
+        lines = ["digraph {"]
+
+        for node, identifier in identifiers.items():
+            shape = "point" if node.is_barrier else "box"
+            style = ", style=dashed" if node.is_complete() else ""
+            lines.append(
+                f'    {identifier} [label="{node.job_name}", shape={shape}{style}];'
+            )
+
+        for node, identifier in identifiers.items():
+            for dependency in node.dependencies:
+                if (upstream := self.upstream(dependency)) is not None:
+                    lines.append(f"    {identifiers[upstream]} -> {identifier};")
+
+        lines.append("}")
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,232 @@
+import os
+import subprocess
+import threading
+import uuid
+
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+def available_vcpus() -> int:
+    return int(os.environ.get("LOCAL_VCPUS", len(os.sched_getaffinity(0))))
+
+
+def available_memory() -> int:
+    "Memory of the machine in MiB"
+
+    physical_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return int(os.environ.get("LOCAL_MEMORY", physical_memory // 2**20))
+
+
+@dataclass
+class LocalJob:
+    id: str
+    name: str
+    command: Optional[str]
+    vcpu: int
+    memory: int
+    depends_on: list[str]
+    attempts: int
+    environment: dict
+    status: str = "PENDING"
+    exit_code: Optional[int] = None
+    completion: Future = field(default_factory=Future)
+
+
+class LocalScheduler:
+    "Runs jobs as processes on this machine, admitting them while their vCPU and memory requests fit"
+
+    def __init__(self, vcpus: int = None, memory: int = None):
+        self.vcpus = vcpus or available_vcpus()
+        self.memory = memory or available_memory()
+
+        self.free_vcpus = self.vcpus
+        self.free_memory = self.memory
+
+        self.jobs: dict[str, LocalJob] = {}
+        self.queue: list[LocalJob] = []
+
+        self.condition = threading.Condition()
+
+        threading.Thread(target=self.schedule, daemon=True).start()
+
+    def execute(
+        self,
+        command: str,
+        job_name: str,
+        vcpu: int,
+        memory: int,
+        depends_on: list,
+        retry_attempts: int,
+        job_queue: str,
+        environment: dict,
+    ) -> str:
+        return self.submit(
+            command,
+            job_name,
+            vcpu,
+            memory,
+            depends_on,
+            retry_attempts,
+            {key: str(value) for key, value in environment.items()},
+        )
+
+    def execute_array(
+        self,
+        commands: list[str],
+        job_name: str,
+        vcpu: int,
+        memory: int,
+        depends_on: list,
+        each_depends_on: list,
+        retry_attempts: int,
+        job_queue: str,
+        environment: dict,
+    ) -> str:
+        "Run the children as separate jobs, named like Batch's array children"
+
+        array_id = str(uuid.uuid4())
+
+        children = [
+            self.submit(
+                command,
+                job_name,
+                vcpu,
+                memory,
+                depends_on + each_depends_on[index : index + 1],
+                retry_attempts,
+                {key: str(value) for key, value in environment.items()}
+                | {"AWS_BATCH_JOB_ARRAY_INDEX": str(index)},
+                id=f"{array_id}:{index}",
+            )
+            for index, command in enumerate(commands)
+        ]
+
+        return self.submit(
+            None, job_name, vcpu=0, memory=0, depends_on=children, id=array_id
+        )
+
+    def wait(self, dependencies: list) -> str:
+        "Stand for a set of jobs without running a process"
+
+        return self.submit(None, "WAIT", vcpu=0, memory=0, depends_on=dependencies)
+
+    def submit(
+        self,
+        command: Optional[str],
+        job_name: str,
+        vcpu: int = 1,
+        memory: int = 2048,
+        depends_on: list = [],
+        attempts: int = 1,
+        environment: dict = {},
+        id: str = None,
+    ) -> str:
+        job = LocalJob(
+            id=id or str(uuid.uuid4()),
+            name=job_name,
+            command=command,
+            # a request larger than the machine is admitted once the machine is idle
+            vcpu=min(vcpu, self.vcpus),
+            memory=min(memory, self.memory),
+            depends_on=[
+                job.result() if isinstance(job, Future) else job for job in depends_on
+            ],
+            attempts=max(attempts, 1),
+            environment=environment,
+        )
+
+        with self.condition:
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self.condition.notify()
+
+        return job.id
+
+    def dependency_status(self, job: LocalJob) -> str:
+        statuses = {
+            self.jobs[dependency].status
+            for dependency in job.depends_on
+            # jobs unknown to this scheduler were run before it started
+            if dependency in self.jobs
+        }
+
+        if "FAILED" in statuses:
+            return "FAILED"
+        if statuses <= {"SUCCEEDED"}:
+            return "SUCCEEDED"
+        return "PENDING"
+
+    def schedule(self):
+        with self.condition:
+            while True:
+                while self.admit():
+                    pass
+
+                self.condition.wait()
+
+    def admit(self) -> bool:
+        "Start or fail every queued job that can be, and report whether any was"
+
+        progress = False
+
+        for job in list(self.queue):
+            dependency_status = self.dependency_status(job)
+
+            if dependency_status == "PENDING":
+                continue
+
+            if dependency_status == "FAILED":
+                self.queue.remove(job)
+                self.finish(job, "FAILED")
+                progress = True
+                continue
+
+            if job.command is None:
+                self.queue.remove(job)
+                self.finish(job, "SUCCEEDED")
+                progress = True
+                continue
+
+            if job.vcpu > self.free_vcpus or job.memory > self.free_memory:
+                continue
+
+            self.queue.remove(job)
+            self.free_vcpus -= job.vcpu
+            self.free_memory -= job.memory
+            job.status = "RUNNING"
+            progress = True
+
+            threading.Thread(target=self.run, args=(job,), daemon=True).start()
+
+        return progress
+
+    def run(self, job: LocalJob):
+        for _ in range(job.attempts):
+            job.exit_code = subprocess.run(
+                ["worker", job.command], env=os.environ | job.environment
+            ).returncode
+
+            if job.exit_code == 0:
+                break
+
+        with self.condition:
+            self.free_vcpus += job.vcpu
+            self.free_memory += job.memory
+            self.finish(job, "SUCCEEDED" if job.exit_code == 0 else "FAILED")
+
+    def finish(self, job: LocalJob, status: str):
+        job.status = status
+        job.completion.set_result(status)
+        self.condition.notify()
+
+    def drain(self):
+        for job in list(self.jobs.values()):
+            job.completion.result()
+
+        failed_jobs = [job for job in self.jobs.values() if job.status == "FAILED"]
+
+        if failed_jobs:
+            names = ", ".join(sorted({job.name for job in failed_jobs}))
+            raise RuntimeError(f"{len(failed_jobs)} local jobs failed: {names}")
@@ -1,37 +1,454 @@
 import argparse
 import boto3
+import fcntl
 import fileinput
+import fnmatch
+import json
+import math
 import os
+import re
+import socket
+import socketserver
+import subprocess
+import sys
+import telemetry
+import tempfile
+import threading
 import time
 
+from local import LocalScheduler
+from pathlib import Path
+from typing import Optional
+
+# batch submits every job to AWS Batch, local runs them inside the current job
+LSF_MODE = os.environ.get("LSF_MODE", "batch")
+LSF_SOCKET = os.environ.get("LSF_SOCKET", "/tmp/lsf.sock")
+
+lsf_directory = Path(os.environ["FILE_SYSTEM_MOUNT_POINT"]) / "lsf"
+
+memory_profile = lsf_directory / "memory.json"
+submissions_directory = lsf_directory / "submissions"
+recent_directory = lsf_directory / "recent"
+
+# memory of PORT's queues in port.cfg, in MiB
+MEMORY_TIERS = (3072, 6144, 10240, 15360, 30720, 46080, 61440)
+MEMORY_MARGIN = float(os.environ.get("LSF_MEMORY_MARGIN", 1.2))
+# memory of the worker on top of the tool's
+MEMORY_OVERHEAD = 512
+
+ACTIVE_STATUSES = ("SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING")
+
+# one poller refreshes the statuses that every bjobs reads, and stops once unread
+STATUS_POLL_INTERVAL = float(os.environ.get("LSF_POLL_INTERVAL", 5))
+STATUS_MAX_AGE = float(os.environ.get("LSF_STATUS_MAX_AGE", 30))
+POLLER_IDLE_TIMEOUT = float(os.environ.get("LSF_POLLER_IDLE_TIMEOUT", 600))
+POLLER_START_TIMEOUT = 60
+# how long a submitted job may take to show up in Batch's listings
+LISTING_DELAY = 30
+DESCRIBE_JOBS_LIMIT = 100
+
+DAEMON_START_TIMEOUT = 60
+DAEMON_IDLE_TIMEOUT = float(os.environ.get("LSF_DAEMON_IDLE_TIMEOUT", 600))
+
+
+def write_json(path: Path, value):
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # write then rename, so the file is never read half written
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, suffix=".tmp", delete=False
+    ) as file:
+        json.dump(value, file)
+
+    os.replace(file.name, path)
+
+
+def read_json(path: Path, default=None):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return default
+
+
+def job_pattern(job_name: str) -> str:
+    "Job name with its numbers generalized, so that one profile covers every sample"
+
+    return re.sub(r"\d+", "*", job_name)
+
+
+def requested_memory(job_name: str, memory: str) -> int:
+    "Memory for a job from the profile of its name or, without one, from its -M request"
+
+    profile = read_json(memory_profile, {})
+    patterns = [
+        pattern for pattern in profile if fnmatch.fnmatchcase(job_name, pattern)
+    ]
+
+    if patterns:
+        peak = profile[max(patterns, key=len)]
+        return 256 * math.ceil((peak * MEMORY_MARGIN + MEMORY_OVERHEAD) / 256)
+
+    memory = int(memory) + MEMORY_OVERHEAD
+
+    if "filtersam" in job_name or "get_novel_exons" in job_name:
+        memory += 3072
+
+    return memory
+
+
+def job_environment(submission: dict) -> dict:
+    return {
+        "STDOUT_LOG": submission["output_file"],
+        "STDERR_LOG": submission["error_file"],
+        "JOB_NAME": submission["job_name"],
+        "REQUESTED_VCPU": "1",
+        "REQUESTED_MEMORY": str(submission["memory"]),
+    }
+
+
+def submit(batch, submission: dict) -> str:
+    environment = job_environment(submission)
+
+    job_id = batch.submit_job(
+        jobName=submission["job_name"],
+        jobQueue=os.environ["JOB_QUEUE_ARN"],
+        jobDefinition=os.environ["WORKER_JOB_DEFINITION_NAME"],
+        containerOverrides={
+            "command": ["worker", submission["commands"]],
+            "environment": [
+                {"name": key, "value": value} for key, value in environment.items()
+            ],
+            "resourceRequirements": [
+                {"type": "MEMORY", "value": str(submission["memory"])},
+                {"type": "VCPU", "value": "1"},
+            ],
+        },
+    )["jobId"]
+
+    # kept so that a job killed for lack of memory can be submitted again
+    write_json(submissions_directory / f"{job_id}.json", submission)
+    # kept until the job shows up in the cached statuses
+    write_json(
+        recent_directory / f"{job_id}.json",
+        {"job_name": submission["job_name"], "submitted": time.time()},
+    )
+
+    return job_id
+
+
+def is_out_of_memory(job: dict) -> bool:
+    reasons = (job.get("statusReason", ""), job.get("container", {}).get("reason", ""))
+    return any("OutOfMemory" in reason for reason in reasons)
+
+
+def resubmit_out_of_memory(batch) -> list[str]:
+    "Submit the failed jobs that ran out of memory again at the next memory tier"
+
+    resubmitted = []
+
+    # only the jobs with a record are described, and a record is kept until its job is done
+    job_ids = [record.stem for record in submissions_directory.glob("*.json")]
+
+    for start in range(0, len(job_ids), DESCRIBE_JOBS_LIMIT):
+        jobs = batch.describe_jobs(jobs=job_ids[start : start + DESCRIBE_JOBS_LIMIT])
+
+        for job in jobs["jobs"]:
+            record = submissions_directory / f"{job['jobId']}.json"
+            failed = submissions_directory / "failed" / record.name
+
+            if job["status"] == "SUCCEEDED":
+                record.unlink(missing_ok=True)
+                continue
+
+            if job["status"] != "FAILED" or not record.exists():
+                continue
+
+            # the rename claims the job, in case several bjobs run at once
+            failed.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.rename(record, failed)
+            except FileNotFoundError:
+                continue
+
+            if not is_out_of_memory(job):
+                continue
+
+            submission = json.loads(failed.read_text())
+            memory = next(
+                (tier for tier in MEMORY_TIERS if tier > submission["memory"]), None
+            )
+
+            if memory is None:
+                print(
+                    f"{submission['job_name']} ran out of {submission['memory']} MiB",
+                    file=sys.stderr,
+                )
+                continue
+
+            submit(batch, submission | {"memory": memory})
+            resubmitted.append(submission["job_name"])
+
+    return resubmitted
+
+
+def status_file(job_queue: str) -> Path:
+    return lsf_directory / f"{job_queue.rsplit('/', 1)[-1]}.jobs.json"
+
+
+def refresh(batch, job_queue: str) -> dict:
+    "List the active jobs of the queue and cache their statuses"
+
+    started = time.time()
+    jobs = []
+
+    jobs_paginator = batch.get_paginator("list_jobs")
+
+    for status in ACTIVE_STATUSES:
+        for page in jobs_paginator.paginate(jobQueue=job_queue, jobStatus=status):
+            for job in page["jobSummaryList"]:
+                jobs.append([job["jobName"], "RUN" if status == "RUNNING" else "PEND"])
+
+    statuses = {"started": started, "updated": time.time(), "jobs": jobs}
+    write_json(status_file(job_queue), statuses)
+
+    # resubmission is best-effort, and the statuses above are written without it
+    try:
+        resubmitted = resubmit_out_of_memory(batch)
+    except Exception as error:
+        print(f"Could not resubmit jobs out of memory: {error!r}", file=sys.stderr)
+        resubmitted = []
+
+    # jobs that failed since they were listed above are still reported as pending
+    if resubmitted:
+        jobs += [[job_name, "PEND"] for job_name in resubmitted]
+        statuses["updated"] = time.time()
+        write_json(status_file(job_queue), statuses)
+
+    # submissions old enough to be in the listing need not be reported separately
+    for record in recent_directory.glob("*.json"):
+        submission = read_json(record)
+        if submission and submission["submitted"] < started - LISTING_DELAY:
+            record.unlink(missing_ok=True)
+
+    return statuses
+
+
+def poller():
+    "Refresh the cached statuses of the queue until bjobs stops reading them"
 
-def bjobs():
     batch = boto3.client("batch")
+    job_queue = os.environ["JOB_QUEUE_ARN"]
+    statuses = status_file(job_queue)
 
+    with open(statuses.with_suffix(".lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        read = statuses.with_suffix(".read")
+
+        while time.time() - read.stat().st_mtime < POLLER_IDLE_TIMEOUT:
+            try:
+                refresh(batch, job_queue)
+            except Exception as error:
+                print(f"Could not refresh job statuses: {error!r}", file=sys.stderr)
+
+            time.sleep(STATUS_POLL_INTERVAL)
+
+
+def start_poller():
+    with open(lsf_directory / "poller.log", "ab") as log:
+        subprocess.Popen(
+            [sys.executable, "-c", "import lsf; lsf.poller()"],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+        )
+
+
+def is_fresh(statuses: Optional[dict]) -> bool:
+    return statuses is not None and time.time() - statuses["updated"] < STATUS_MAX_AGE
+
+
+def cached_statuses(job_queue: str) -> dict:
+    statuses = status_file(job_queue)
+
+    lsf_directory.mkdir(parents=True, exist_ok=True)
+    statuses.with_suffix(".read").touch()
+
+    deadline = time.time() + POLLER_START_TIMEOUT
+    poller_started = False
+
+    while not is_fresh(cached := read_json(statuses)):
+        if not poller_started:
+            start_poller()
+            poller_started = True
+
+        if time.time() > deadline:
+            return refresh(boto3.client("batch"), job_queue)
+
+        time.sleep(0.2)
+
+    return cached
+
+
+def active_jobs(scheduler: LocalScheduler) -> list[list[str]]:
+    with scheduler.condition:
+        return [
+            [job.name, "RUN" if job.status == "RUNNING" else "PEND"]
+            for job in scheduler.jobs.values()
+            if job.status in ("PENDING", "RUNNING")
+        ]
+
+
+def serve(scheduler: LocalScheduler, request: dict):
+    if "submit" in request:
+        submission = request["submit"]
+        return scheduler.submit(
+            submission["commands"],
+            submission["job_name"],
+            vcpu=1,
+            memory=submission["memory"],
+            environment=job_environment(submission),
+        )
+
+    return active_jobs(scheduler)
+
+
+def daemon():
+    "Run the jobs submitted with bsub on this machine, until none has been for a while"
+
+    with open(f"{LSF_SOCKET}.lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        vcpus = memory = None
+
+        # pack the jobs into the resources of the job this runs in, less PORT's own
+        if "REQUESTED_MEMORY" in os.environ:
+            vcpus = int(float(os.environ["REQUESTED_VCPU"]))
+            memory = int(float(os.environ["REQUESTED_MEMORY"])) - MEMORY_OVERHEAD
+
+        # the jobs are not steps of the job this runs in
+        os.environ.pop("CACHE_STEP", None)
+
+        scheduler = LocalScheduler(vcpus, memory)
+        last_request = time.time()
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                nonlocal last_request
+                last_request = time.time()
+
+                response = serve(scheduler, json.loads(self.rfile.readline()))
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+
+        Path(LSF_SOCKET).unlink(missing_ok=True)
+        server = socketserver.ThreadingUnixStreamServer(LSF_SOCKET, Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        while (
+            active_jobs(scheduler) or time.time() - last_request < DAEMON_IDLE_TIMEOUT
+        ):
+            time.sleep(STATUS_POLL_INTERVAL)
+
+        server.shutdown()
+        server.server_close()
+        Path(LSF_SOCKET).unlink(missing_ok=True)
+
+        # jobs submitted while shutting down
+        for job in list(scheduler.jobs.values()):
+            job.completion.result()
+
+
+def start_daemon():
+    with open(f"{LSF_SOCKET}.log", "ab") as log:
+        subprocess.Popen(
+            [sys.executable, "-c", "import lsf; lsf.daemon()"],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+        )
+
+
+def request(message: dict):
+    "Send a request to the local scheduler, starting it if need be"
+
+    deadline = time.time() + DAEMON_START_TIMEOUT
+    next_start = time.time()
+
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX) as connection:
+                connection.connect(LSF_SOCKET)
+                connection.sendall(json.dumps(message).encode() + b"\n")
+                return json.loads(connection.makefile().readline())
+        # a daemon that is shutting down resets the connections it has not served
+        except (FileNotFoundError, ConnectionRefusedError, ConnectionResetError):
+            if time.time() > deadline:
+                raise
+
+        # a daemon started while another shuts down exits at once, so try again
+        if time.time() >= next_start:
+            start_daemon()
+            next_start = time.time() + 1
+
+        time.sleep(0.2)
+
+
+def batch_jobs() -> list[list[str]]:
+    job_queue = os.environ["JOB_QUEUE_ARN"]
+
+    # read before the statuses, whose refresh removes the submissions it lists
+    recent = list(filter(None, map(read_json, recent_directory.glob("*.json"))))
+    jobs = cached_statuses(job_queue)["jobs"]
+
+    listed = {job_name for job_name, _ in jobs}
+
+    return jobs + [
+        [submission["job_name"], "PEND"]
+        for submission in recent
+        if submission["job_name"] not in listed
+    ]
+
+
+def bjobs():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-w",
         help="Displays job information without truncating fields",
         action="store_true",
     )
-    parser.parse_args()
+    parser.add_argument(
+        "-J",
+        "--job_name",
+        help="Displays only the jobs whose names start with the specified prefix",
+    )
+    args = parser.parse_args()
 
-    job_queue = os.environ["JOB_QUEUE_ARN"]
-    jobs_paginator = batch.get_paginator("list_jobs")
+    jobs = request({"jobs": None}) if LSF_MODE == "local" else batch_jobs()
 
-    for status in ("SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING"):
-        for page in jobs_paginator.paginate(jobQueue=job_queue, jobStatus=status):
-            time.sleep(0.1)
-            for job in page["jobSummaryList"]:
-                job_name = job["jobName"].replace("-", ".")
-                print(job_name, "RUN" if status == "RUNNING" else "PEND")
+    prefix = (args.job_name or "").rstrip("*")
 
-    time.sleep(1.5)
+    for job_name, status in jobs:
+        job_name = job_name.replace("-", ".")
 
+        if not job_name.startswith(prefix):
+            continue
+
+        # LSF shows only the end of long names unless asked for them in full
+        if not args.w and len(job_name) > 10:
+            job_name = "*" + job_name[-9:]
+
+        print(job_name, status)
 
-def bsub():
-    batch = boto3.client("batch")
 
+def bsub():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-J", "--job_name", help="Assigns the specified name to the job"
@@ -56,25 +473,35 @@ def bsub():
     job_name = args.job_name.replace(".", "-")
     commands = "".join(fileinput.input(files=("-",)))
 
-    memory = int(args.memory) + 512
+    submission = {
+        "job_name": job_name,
+        "commands": commands,
+        "memory": requested_memory(job_name, args.memory),
+        "output_file": args.output_file,
+        "error_file": args.error_file,
+    }
 
-    if "filtersam" or "get_novel_exons" in job_name:
-        memory += 3072
+    if LSF_MODE == "local":
+        request({"submit": submission})
+    else:
+        submit(boto3.client("batch"), submission)
 
-    environment = {"STDOUT_LOG": args.output_file, "STDERR_LOG": args.error_file}
 
-    batch.submit_job(
-        jobName=job_name,
-        jobQueue=os.environ["JOB_QUEUE_ARN"],
-        jobDefinition=os.environ["WORKER_JOB_DEFINITION_NAME"],
-        containerOverrides={
-            "command": ["worker", commands],
-            "environment": [
-                {"name": key, "value": value} for key, value in environment.items()
-            ],
-            "resourceRequirements": [
-                {"type": "MEMORY", "value": str(memory)},
-                {"type": "VCPU", "value": "1"},
-            ],
-        },
+def profile():
+    parser = argparse.ArgumentParser(
+        description="Learn the memory bsub requests per job name pattern from the metrics of previous runs"
     )
+    parser.add_argument("directories", nargs="+", type=Path)
+    arguments = parser.parse_args()
+
+    profile = read_json(memory_profile, {})
+
+    for run in telemetry.load(arguments.directories):
+        if run["exit_code"] == 0:
+            pattern = job_pattern(run["job_name"])
+            profile[pattern] = max(profile.get(pattern, 0), telemetry.peak_memory(run))
+
+    write_json(memory_profile, profile)
+
+    for pattern, peak in sorted(profile.items()):
+        print(pattern, f"{peak:.0f}", sep="\t")
@@ -0,0 +1,87 @@
+import asyncio
+import gzip
+import os
+
+from typing import BinaryIO
+
+CHUNK_SIZE = int(os.environ.get("LOG_CHUNK_SIZE", 1 << 16))
+BUFFERED_CHUNKS = int(os.environ.get("LOG_BUFFERED_CHUNKS", 256))
+
+
+def open_log(path: str) -> BinaryIO:
+    "Open a log for appending, compressed as LOG_COMPRESSION (gzip or zstd) asks"
+
+    compression = os.environ.get("LOG_COMPRESSION")
+
+    if compression == "gzip":
+        return gzip.open(f"{path}.gz", "ab", compresslevel=1)
+
+    if compression == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor().stream_writer(open(f"{path}.zst", "ab"))
+
+    return open(path, "ab")
+
+
+class LogTarget:
+    "Bounded buffer in front of a file that is written from a thread"
+
+    # when the buffer is full, a lossless target makes the reader wait while a lossy
+    # one drops the chunk, so that a slow console cannot hold up the tool
+    def __init__(self, file: BinaryIO, lossy: bool = False):
+        self.file = file
+        self.lossy = lossy
+        self.queue = asyncio.Queue(BUFFERED_CHUNKS)
+        self.dropped = 0
+
+    async def put(self, chunk: bytes):
+        if not self.lossy:
+            return await self.queue.put(chunk)
+
+        try:
+            self.queue.put_nowait(chunk)
+        except asyncio.QueueFull:
+            self.dropped += len(chunk)
+
+    async def write(self):
+        while True:
+            chunks = [await self.queue.get()]
+
+            while not self.queue.empty():
+                chunks.append(self.queue.get_nowait())
+
+            end = chunks[-1] is None
+            data = b"".join(chunks[:-1] if end else chunks)
+
+            if data:
+                await asyncio.to_thread(self.file.write, data)
+
+            if end:
+                await asyncio.to_thread(self.file.flush)
+                return
+
+    async def close(self):
+        await self.queue.put(None)
+
+
+async def tee(stream: asyncio.StreamReader, targets: list[LogTarget]):
+    "Copy a stream to every target in chunks, without decoding or splitting lines"
+
+    writers = [asyncio.create_task(target.write()) for target in targets]
+
+    while chunk := await stream.read(CHUNK_SIZE):
+        for target in targets:
+            await target.put(chunk)
+
+    for target in targets:
+        await target.close()
+
+    await asyncio.gather(*writers)
+
+    for target in targets:
+        if target.dropped:
+            message = (
+                f"\n[worker] {target.dropped} bytes were not copied to the console\n"
+            )
+            target.file.write(message.encode())
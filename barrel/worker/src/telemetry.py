@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+from pathlib import Path
+from typing import Optional
+
+SAMPLE_INTERVAL = float(os.environ.get("TELEMETRY_INTERVAL", 2))
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+CGROUP_PEAK_MEMORY_FILES = (
+    "/sys/fs/cgroup/memory.peak",
+    "/sys/fs/cgroup/memory/memory.max_usage_in_bytes",
+)
+
+
+def children() -> dict[int, list[int]]:
+    tree = {}
+
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+
+        try:
+            stat = Path(entry.path, "stat").read_text()
+        except OSError:
+            continue
+
+        # the command name in parentheses may contain spaces
+        parent = int(stat.rsplit(")", 1)[1].split()[1])
+        tree.setdefault(parent, []).append(int(entry.name))
+
+    return tree
+
+
+def descendants(pid: int) -> list[int]:
+    tree = children()
+    processes = [pid]
+
+    for process in processes:
+        processes.extend(tree.get(process, []))
+
+    return processes
+
+
+def sample(pid: int) -> Optional[tuple[int, int, int]]:
+    "Resident memory, characters read and characters written by a process"
+
+    try:
+        resident_pages = int(Path(f"/proc/{pid}/statm").read_text().split()[1])
+        io = dict(
+            line.split(": ")
+            for line in Path(f"/proc/{pid}/io").read_text().splitlines()
+        )
+    except (OSError, ValueError):
+        return None
+
+    return resident_pages * PAGE_SIZE, int(io["rchar"]), int(io["wchar"])
+
+
+def cgroup_peak_memory() -> Optional[int]:
+    for file in CGROUP_PEAK_MEMORY_FILES:
+        try:
+            return int(Path(file).read_text())
+        except (OSError, ValueError):
+            continue
+
+    return None
+
+
+class Monitor:
+    "Samples the memory and I/O of a process and all of its descendants from a thread"
+
+    def __init__(self, pid: int, interval: float = SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.peak_resident_memory = 0
+        # the last counters seen for every process, which outlive the process
+        self.io: dict[int, tuple[int, int]] = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.started = time.time()
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            resident_memory = 0
+
+            for process in descendants(self.pid):
+                if (sampled := sample(process)) is None:
+                    continue
+
+                resident_memory += sampled[0]
+                self.io[process] = sampled[1:]
+
+            self.peak_resident_memory = max(self.peak_resident_memory, resident_memory)
+
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.finished = time.time()
+        self.stopped.set()
+        self.thread.join()
+
+    def metrics(self, exit_code: int) -> dict:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        peak_cgroup_memory = cgroup_peak_memory()
+
+        return {
+            "job_name": os.environ.get("JOB_NAME"),
+            "job_id": os.environ.get("AWS_BATCH_JOB_ID"),
+            "requested_vcpu": float(os.environ.get("REQUESTED_VCPU", "nan")),
+            "requested_memory": float(os.environ.get("REQUESTED_MEMORY", "nan")),
+            "started": self.started,
+            "wall_time": self.finished - self.started,
+            "user_time": usage.ru_utime,
+            "system_time": usage.ru_stime,
+            # largest single process, summed process tree and whole container, in MiB
+            "peak_process_memory": usage.ru_maxrss / 1024,
+            "peak_tree_memory": self.peak_resident_memory / 2**20,
+            "peak_cgroup_memory": peak_cgroup_memory and peak_cgroup_memory / 2**20,
+            "bytes_read": sum(read for read, _ in self.io.values()),
+            "bytes_written": sum(written for _, written in self.io.values()),
+            "block_input_operations": usage.ru_inblock,
+            "block_output_operations": usage.ru_oublock,
+            "exit_code": exit_code,
+        }
+
+
+def metrics_file(stdout_log: str) -> Path:
+    "A metrics file next to the job's log, unique to this run of the job"
+
+    job_id = os.environ.get("AWS_BATCH_JOB_ID", str(uuid.uuid4())).replace(":", ".")
+    stdout_log = Path(stdout_log)
+
+    return stdout_log.with_name(f"{stdout_log.stem}.{job_id}.metrics.json")
+
+
+def record(monitor: Monitor, exit_code: int, stdout_log: str):
+    try:
+        metrics_file(stdout_log).write_text(
+            json.dumps(monitor.metrics(exit_code), indent=4)
+        )
+    except OSError as error:
+        print(f"Could not record job metrics: {error}", file=sys.stderr)
+
+
+def load(directories: list[Path]) -> list[dict]:
+    "Metrics of every job recorded under the directories"
+
+    runs = []
+
+    for directory in directories:
+        for file in Path(directory).rglob("*.metrics.json"):
+            metrics = json.loads(file.read_text())
+            metrics["job_name"] = metrics["job_name"] or file.name.split(".")[0]
+            runs.append(metrics)
+
+    return runs
+
+
+def peak_memory(run: dict) -> float:
+    return max(run["peak_tree_memory"], run["peak_process_memory"])
+
+
+def summarize():
+    parser = argparse.ArgumentParser(
+        description="Summarize the resource usage of jobs per job name"
+    )
+    parser.add_argument("directories", nargs="+", type=Path)
+    parser.add_argument(
+        "--margin",
+        type=float,
+        default=1.2,
+        help="Factor applied to the peak memory to suggest a memory request",
+    )
+    arguments = parser.parse_args()
+
+    jobs = {}
+
+    for run in load(arguments.directories):
+        jobs.setdefault(run["job_name"], []).append(run)
+
+    columns = [
+        "job_name",
+        "jobs",
+        "failed",
+        "mean_wall_time",
+        "max_wall_time",
+        "requested_vcpu",
+        "cpu_utilization",
+        "requested_memory",
+        "peak_memory",
+        "suggested_memory",
+        "gib_read",
+        "gib_written",
+    ]
+
+    print("\t".join(columns))
+
+    for name, runs in sorted(jobs.items()):
+        peak = max(map(peak_memory, runs))
+        requested_vcpu = max(run["requested_vcpu"] for run in runs)
+        cpu_time = sum(run["user_time"] + run["system_time"] for run in runs)
+        vcpu_time = sum(run["wall_time"] * run["requested_vcpu"] for run in runs)
+
+        row = [
+            name,
+            len(runs),
+            sum(run["exit_code"] != 0 for run in runs),
+            f"{statistics.mean(run['wall_time'] for run in runs):.0f}",
+            f"{max(run['wall_time'] for run in runs):.0f}",
+            f"{requested_vcpu:g}",
+            f"{cpu_time / vcpu_time:.2f}" if vcpu_time else "nan",
+            f"{max(run['requested_memory'] for run in runs):.0f}",
+            f"{peak:.0f}",
+            f"{peak * arguments.margin:.0f}",
+            f"{sum(run['bytes_read'] for run in runs) / 2**30:.2f}",
+            f"{sum(run['bytes_written'] for run in runs) / 2**30:.2f}",
+        ]
+
+        print("\t".join(map(str, row)))
@@ -1,45 +1,628 @@
 import argparse
 import boto3
+import collections
+import hashlib
+import itertools
+import json
 import os
+import sys
+import threading
+import uuid
 import worker
+import zlib
 
+from bioinformatics.fastq import Statistics
+from botocore.config import Config
+from cache import digest
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import suppress
 from pathlib import Path
+from typing import BinaryIO, Callable, Optional
 from urllib.parse import urlparse
 
+TRANSFER_CONCURRENCY = int(os.environ.get("TRANSFER_CONCURRENCY", 16))
+TRANSFER_PART_SIZE = int(os.environ.get("TRANSFER_PART_SIZE", 64 * 2**20))
+READ_SIZE = 1 << 20
+
+TRANSFER_FILES_PER_JOB = int(os.environ.get("TRANSFER_FILES_PER_JOB", 200))
+TRANSFER_FILES_IN_FLIGHT = int(os.environ.get("TRANSFER_FILES_IN_FLIGHT", 8))
+
+FASTQ_SUFFIXES = (".fastq", ".fq", ".fastq.gz", ".fq.gz")
+
+
+class VerificationError(Exception):
+    pass
+
+
+def transfer_command(source: str, destination: Path) -> str:
+    command = f"transfer --source={source} --destination={destination}"
+
+    # with a step cache, a changed source must be transferred again
+    if worker.cache is not None:
+        return command
+
+    return f"if [ ! -f '{destination}' ]; then {command}; fi"
+
 
 def transfer(source: str, destination: Path):
     return worker.execute(
-        f"if [ ! -f '{destination}' ]; then transfer --source={source} --destination={destination}; fi",
+        transfer_command(source, destination),
         job_name="FILE_TRANSFER",
         job_queue=os.environ["JOB_QUEUE_ARN"],
         memory=4096,
         retry_attempts=2,
+        outputs=[destination],
+        inputs=[source],
+        version="transfer",
     )
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--source")
-    parser.add_argument("--destination")
-    transfer = parser.parse_args()
+def transfer_bulk(
+    transfers: list[tuple[str, Path]],
+    files_per_job: int = TRANSFER_FILES_PER_JOB,
+    statistics: bool = False,
+) -> list[worker.Job]:
+    "Transfer (source, destination) pairs with one job per manifest of files, returning the job of each file"
+
+    jobs = [None] * len(transfers)
+    pending = []
+
+    for index, (source, destination) in enumerate(transfers):
+        # without a step cache, files already transferred are left alone
+        if worker.cache is None and Path(destination).exists():
+            jobs[index] = worker.wait([])
+        else:
+            pending.append(index)
+
+    manifests_directory = worker.logs_directory.parent / "manifests"
+    manifests_directory.mkdir(parents=True, exist_ok=True)
+
+    chunks = [
+        pending[start : start + files_per_job]
+        for start in range(0, len(pending), files_per_job)
+    ]
+    commands = []
+
+    for chunk in chunks:
+        files = [[transfers[index][0], str(transfers[index][1])] for index in chunk]
+
+        # named by content, so that the command of the same transfer does not change
+        manifest = manifests_directory / f"FILE_TRANSFER-{digest(files)[:16]}.json"
+        manifest.write_text(json.dumps(files))
+        commands.append(
+            f"transfer --manifest={manifest}" + (" --statistics" if statistics else "")
+        )
+
+    parameters = dict(
+        job_name="FILE_TRANSFER",
+        job_queue=os.environ["JOB_QUEUE_ARN"],
+        memory=4096,
+        retry_attempts=2,
+    )
+
+    if len(chunks) == 1:
+        job = worker.execute(
+            commands[0],
+            outputs=[transfers[index][1] for index in pending],
+            inputs=[transfers[index][0] for index in pending],
+            version="transfer",
+            **parameters,
+        )
+        for index in pending:
+            jobs[index] = job
+    elif chunks:
+        array = worker.execute_array(commands, **parameters)
+        for number, chunk in enumerate(chunks):
+            for index in chunk:
+                jobs[index] = worker.child(array, number)
+
+    return jobs
+
+
+def md5(path: Path, start: int, length: int) -> bytes:
+    digest = hashlib.md5()
+
+    with open(path, "rb") as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(READ_SIZE, length))
+            digest.update(chunk)
+            length -= len(chunk)
+
+    return digest.digest()
+
+
+def etag(path: Path, size: int, part_size: int, parts: Optional[int], pool) -> str:
+    "ETag of an object with the content of the file, uploaded whole or in parts"
+
+    if parts is None:
+        return md5(path, 0, size).hex()
+
+    digests = pool.map(
+        lambda start: md5(path, start, min(part_size, size - start)),
+        range(0, size, part_size),
+    )
+
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{parts}"
+
+
+class StreamingETag:
+    "ETag of content given in order, as S3 computes it for an upload in parts of the given size"
+
+    def __init__(self, part_size: int, parts: Optional[int]):
+        self.part_size = part_size
+        self.parts = parts
+        self.digests = []
+        self.digest = hashlib.md5()
+        self.filled = 0
+
+    def update(self, data: bytes):
+        if self.parts is None:
+            return self.digest.update(data)
+
+        data = memoryview(data)
+
+        while data:
+            taken = data[: self.part_size - self.filled]
+            self.digest.update(taken)
+            self.filled += len(taken)
+            data = data[len(taken) :]
+
+            if self.filled == self.part_size:
+                self.digests.append(self.digest.digest())
+                self.digest = hashlib.md5()
+                self.filled = 0
+
+    def hexdigest(self) -> str:
+        if self.parts is None:
+            return self.digest.hexdigest()
+
+        digests = self.digests + ([self.digest.digest()] if self.filled else [])
+
+        return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def upload_parts(s3, bucket: str, key: str, head: dict) -> Optional[tuple]:
+    "Part size and number of parts the object's ETag was computed from, if it is an MD5"
+
+    # the ETag of an object encrypted with KMS or a customer key is not its MD5
+    if head.get("ServerSideEncryption", "").startswith("aws:kms"):
+        return None
+    if "SSECustomerAlgorithm" in head:
+        return None
+
+    etag = head["ETag"].strip('"')
+
+    if "-" not in etag:
+        return head["ContentLength"], None
+
+    part = s3.head_object(Bucket=bucket, Key=key, PartNumber=1)
+
+    return part["ContentLength"], int(etag.split("-")[1])
+
+
+def verify(s3, bucket: str, key: str, head: dict, path: Path, pool):
+    size = path.stat().st_size
+
+    if size != head["ContentLength"]:
+        raise VerificationError(f"{path} has {size} bytes, not {head['ContentLength']}")
+
+    if (upload := upload_parts(s3, bucket, key, head)) is None:
+        return
+
+    expected = head["ETag"].strip('"')
+
+    if (actual := etag(path, size, *upload, pool)) != expected:
+        raise VerificationError(f"{path} has ETag {actual}, not {expected}")
+
+
+def download(
+    s3,
+    bucket: str,
+    key: str,
+    destination: Path,
+    concurrency: int = TRANSFER_CONCURRENCY,
+    part_size: int = TRANSFER_PART_SIZE,
+    consume: Callable[[bytes], None] = None,
+):
+    "Download an object in parallel byte ranges, resuming from the ranges already done, and pass its bytes in order to consume"
+
+    head = s3.head_object(Bucket=bucket, Key=key)
+    size = head["ContentLength"]
+
+    # the object is assembled next to the destination and renamed once verified
+    partial = destination.with_name(f"{destination.name}.part")
+    progress_file = destination.with_name(f"{destination.name}.part.json")
+
+    progress = {"etag": head["ETag"], "size": size, "part_size": part_size}
+
+    try:
+        recorded = json.loads(progress_file.read_text())
+    except (OSError, ValueError):
+        recorded = {}
+
+    if partial.exists() and all(recorded.get(k) == v for k, v in progress.items()):
+        completed = set(recorded["completed"])
+    else:
+        completed = set()
+        partial.unlink(missing_ok=True)
+
+    lock = threading.Lock()
+    ready = threading.Condition(lock)
+    failed = threading.Event()
+
+    def record(start: int):
+        with lock:
+            completed.add(start)
+            progress_file.with_suffix(".tmp").write_text(
+                json.dumps(progress | {"completed": sorted(completed)})
+            )
+            os.replace(progress_file.with_suffix(".tmp"), progress_file)
+            ready.notify_all()
+
+    def feed():
+        # ranges are read back while they are still cached, each once the ones before it are done
+        for start in range(0, size, part_size):
+            with ready:
+                ready.wait_for(lambda: start in completed or failed.is_set())
+
+            if failed.is_set():
+                return
+
+            consume(os.pread(descriptor, min(part_size, size - start), start))
+
+    descriptor = os.open(partial, os.O_RDWR | os.O_CREAT)
+
+    def fetch(start: int):
+        end = min(start + part_size, size) - 1
+
+        body = s3.get_object(
+            Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=head["ETag"]
+        )["Body"]
+
+        offset = start
+        for chunk in body.iter_chunks(READ_SIZE):
+            os.pwrite(descriptor, chunk, offset)
+            offset += len(chunk)
 
-    Path(transfer.destination).parent.mkdir(parents=True, exist_ok=True)
+        if offset != end + 1:
+            raise VerificationError(f"Received bytes {start}-{offset - 1} of {end}")
 
-    source = urlparse(transfer.source)
+        record(start)
+
+    try:
+        os.ftruncate(descriptor, size)
+
+        with ThreadPoolExecutor(concurrency) as pool, ThreadPoolExecutor(1) as feeder:
+            feeding = feeder.submit(feed) if consume else None
+
+            try:
+                remaining = [
+                    start
+                    for start in range(0, size, part_size)
+                    if start not in completed
+                ]
+                list(pool.map(fetch, remaining))
+
+                os.fsync(descriptor)
+
+                try:
+                    verify(s3, bucket, key, head, partial, pool)
+                except VerificationError:
+                    partial.unlink()
+                    progress_file.unlink(missing_ok=True)
+                    raise
+            except BaseException:
+                with ready:
+                    failed.set()
+                    ready.notify_all()
+                raise
+
+            if feeding:
+                feeding.result()
+    finally:
+        os.close(descriptor)
+
+    os.replace(partial, destination)
+    progress_file.unlink(missing_ok=True)
+
+
+class GzipDecompressor:
+    "Decompresses gzip data that may consist of several concatenated members"
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(wbits=31)
+        self.truncated = False
+
+    def decompress(self, data: bytes) -> bytes:
+        output = []
+
+        while data:
+            output.append(self.decompressor.decompress(data))
+            self.truncated = not self.decompressor.eof
+
+            if self.truncated:
+                break
+
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(wbits=31)
+
+        return b"".join(output)
+
+
+def stream(
+    s3,
+    bucket: str,
+    key: str,
+    output: BinaryIO,
+    concurrency: int = TRANSFER_CONCURRENCY,
+    part_size: int = TRANSFER_PART_SIZE,
+    decompress: bool = False,
+):
+    "Write an object to output in order, fetching the byte ranges ahead of it in parallel"
+
+    head = s3.head_object(Bucket=bucket, Key=key)
+    size = head["ContentLength"]
+
+    upload = upload_parts(s3, bucket, key, head)
+    checksum = StreamingETag(*upload) if upload else None
+    decompressor = GzipDecompressor() if decompress else None
+
+    def fetch(start: int) -> bytes:
+        end = min(start + part_size, size) - 1
+
+        return s3.get_object(
+            Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=head["ETag"]
+        )["Body"].read()
+
+    received = 0
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        # no more than concurrency ranges are held in memory
+        starts = iter(range(0, size, part_size))
+        ahead = collections.deque(
+            pool.submit(fetch, start) for start in itertools.islice(starts, concurrency)
+        )
+
+        while ahead:
+            data = ahead.popleft().result()
+
+            if (start := next(starts, None)) is not None:
+                ahead.append(pool.submit(fetch, start))
+
+            received += len(data)
+
+            if checksum:
+                checksum.update(data)
+
+            output.write(decompressor.decompress(data) if decompressor else data)
+
+    output.flush()
+
+    if received != size:
+        raise VerificationError(f"Received {received} of {size} bytes of {key}")
+
+    if decompressor and decompressor.truncated:
+        raise VerificationError(f"{key} ends within a gzip member")
+
+    if checksum and (actual := checksum.hexdigest()) != head["ETag"].strip('"'):
+        raise VerificationError(f"{key} has ETag {actual}, not {head['ETag']}")
+
+
+class FastqStatistics:
+    "Statistics of a FASTQ file computed from its bytes as it is downloaded, recorded next to it"
+
+    def __init__(self, destination: Path):
+        self.file = destination.with_name(f"{destination.name}.statistics.json")
+        self.statistics = Statistics()
+        self.decompressor = GzipDecompressor() if destination.suffix == ".gz" else None
+
+    def update(self, data: bytes):
+        if self.statistics is None:
+            return
+
+        data = memoryview(data)
+
+        try:
+            # decompressed a little at a time, so that no range is held decompressed whole
+            for start in range(0, len(data), READ_SIZE):
+                piece = data[start : start + READ_SIZE]
+                self.statistics.update(
+                    self.decompressor.decompress(piece) if self.decompressor else piece
+                )
+        except Exception as error:
+            self.drop(error)
+
+    def record(self):
+        if self.statistics is None:
+            return
+
+        try:
+            summary = self.statistics.summary()
+        except Exception as error:
+            return self.drop(error)
+
+        self.file.write_text(json.dumps(summary))
+
+    def drop(self, error: Exception):
+        "Give up on the statistics, which are not worth failing the download for"
+
+        print(
+            f"Could not compute statistics of {self.file}: {error!r}", file=sys.stderr
+        )
+        self.statistics = None
+
+
+def transfer_file(
+    s3,
+    source: str,
+    destination: Path,
+    concurrency: int,
+    part_size: int,
+    statistics: bool = False,
+):
+    destination.parent.mkdir(parents=True, exist_ok=True)
+
+    source = urlparse(source)
 
     if source.scheme == "s3":
-        bucket = source.netloc
-        key = source.path[1:]
+        fastq = None
 
-        s3 = boto3.resource("s3")
+        if statistics and destination.name.endswith(FASTQ_SUFFIXES):
+            fastq = FastqStatistics(destination)
 
-        configuration = boto3.s3.transfer.TransferConfig(
-            use_threads=False, max_bandwidth=4_000_000
+        download(
+            s3,
+            source.netloc,
+            source.path[1:],
+            destination,
+            concurrency,
+            part_size,
+            fastq and fastq.update,
         )
-        s3.Bucket(bucket).download_file(key, transfer.destination, Config=configuration)
+
+        if fastq:
+            fastq.record()
     elif source.scheme == "file":
         with suppress(FileExistsError):
-            os.symlink(source.path, transfer.destination)
+            os.symlink(source.path, destination)
     else:
         raise NotImplementedError
+
+
+def transfer_manifest(
+    s3,
+    manifest: Path,
+    files_in_flight: int,
+    concurrency: int,
+    part_size: int,
+    statistics: bool = False,
+) -> bool:
+    "Transfer the files of a manifest a few at a time, recording each one that completes"
+
+    # kept across attempts of the job, so that completed files are not transferred again
+    job_id = os.environ.get("AWS_BATCH_JOB_ID", str(uuid.uuid4())).replace(":", ".")
+    status_file = manifest.with_name(f"{manifest.stem}.{job_id}.status.json")
+
+    try:
+        status = json.loads(status_file.read_text())
+    except (OSError, ValueError):
+        status = {}
+
+    transfers = [
+        (source, Path(destination))
+        for source, destination in json.loads(manifest.read_text())
+        if not (status.get(destination) == "done" and Path(destination).exists())
+    ]
+
+    def record(destination: Path, outcome: str):
+        status[str(destination)] = outcome
+        status_file.with_suffix(".tmp").write_text(json.dumps(status, indent=4))
+        os.replace(status_file.with_suffix(".tmp"), status_file)
+
+    with ThreadPoolExecutor(files_in_flight) as pool:
+        futures = {
+            pool.submit(
+                transfer_file,
+                s3,
+                source,
+                destination,
+                max(concurrency // files_in_flight, 1),
+                part_size,
+                statistics,
+            ): (source, destination)
+            for source, destination in transfers
+        }
+
+        for future in as_completed(futures):
+            source, destination = futures[future]
+
+            if (error := future.exception()) is None:
+                print(f"Transferred {source} to {destination}")
+                record(destination, "done")
+            else:
+                print(f"Could not transfer {source}: {error!r}", file=sys.stderr)
+                record(destination, repr(error))
+
+    return all(status[str(destination)] == "done" for _, destination in transfers)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source")
+    parser.add_argument("--destination")
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        help="JSON list of (source, destination) pairs to transfer instead",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write the source to the standard output instead of a destination",
+    )
+    parser.add_argument(
+        "--decompress",
+        action="store_true",
+        help="Decompress the streamed source from gzip",
+    )
+    parser.add_argument(
+        "--statistics",
+        action="store_true",
+        help="Record statistics of downloaded FASTQ files next to them",
+    )
+    parser.add_argument(
+        "--files-in-flight",
+        type=int,
+        default=TRANSFER_FILES_IN_FLIGHT,
+        help="Number of files of the manifest transferred at once",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=TRANSFER_CONCURRENCY,
+        help="Number of byte ranges downloaded at once",
+    )
+    parser.add_argument(
+        "--part-size",
+        type=int,
+        default=TRANSFER_PART_SIZE,
+        help="Size of the byte ranges in bytes",
+    )
+    transfer = parser.parse_args()
+
+    s3 = boto3.client("s3", config=Config(max_pool_connections=transfer.concurrency))
+
+    if transfer.stream:
+        source = urlparse(transfer.source)
+
+        if source.scheme != "s3":
+            raise NotImplementedError
+
+        stream(
+            s3,
+            source.netloc,
+            source.path[1:],
+            sys.stdout.buffer,
+            transfer.concurrency,
+            transfer.part_size,
+            transfer.decompress,
+        )
+    elif transfer.manifest is None:
+        transfer_file(
+            s3,
+            transfer.source,
+            Path(transfer.destination),
+            transfer.concurrency,
+            transfer.part_size,
+            transfer.statistics,
+        )
+    elif not transfer_manifest(
+        s3,
+        transfer.manifest,
+        transfer.files_in_flight,
+        transfer.concurrency,
+        transfer.part_size,
+        transfer.statistics,
+    ):
+        sys.exit(1)
@@ -1,16 +1,533 @@
 import asyncio
+import atexit
 import boto3
+import json
 import os
+import random
 import sys
+import threading
+import time
+import uuid
 
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from cache import Cache, describe_step
+from concurrent.futures import Future, ThreadPoolExecutor
+from graph import Child, Graph, Node
+from local import LocalScheduler
 from pathlib import Path
-from typing import Iterable
+from tee import CHUNK_SIZE, LogTarget, open_log, tee
+from telemetry import Monitor, record
+from typing import Callable, Iterable, Optional
 
 analysis_directory = Path(
     f"{os.environ['FILE_SYSTEM_MOUNT_POINT']}/{os.environ['STUDY_NAME']}/{os.environ['ANALYSIS_NAME']}"
 )
 
 logs_directory = analysis_directory / "logs"
+# commands and cache steps of array jobs, too large for the environment of a job
+arrays_directory = analysis_directory / "arrays"
+
+# Batch allows 50 SubmitJob transactions per second per account
+SUBMIT_JOB_RATE = float(os.environ.get("SUBMIT_JOB_RATE", 50))
+SUBMISSION_THREADS = int(os.environ.get("SUBMISSION_THREADS", 16))
+
+THROTTLING_ERRORS = ("TooManyRequestsException", "ThrottlingException")
+
+# Batch accepts at most 20 dependencies per job and 100 jobs per DescribeJobs call
+DEPENDENCY_LIMIT = 20
+DESCRIBE_JOBS_LIMIT = 100
+ARRAY_SIZE_LIMIT = 10000
+DEPENDENCY_POLL_INTERVAL = float(os.environ.get("DEPENDENCY_POLL_INTERVAL", 30))
+# consecutive failed polls after which the held jobs are failed rather than held forever
+DEPENDENCY_POLL_ATTEMPTS = int(os.environ.get("DEPENDENCY_POLL_ATTEMPTS", 10))
+
+# A future resolves to a job ID, or to a list of job IDs when it stands for a wait();
+# nodes and their children stand for jobs recorded in a graph
+Job = str | Future | Node | Child
+
+
+def resolve(job: Job) -> str | list[str]:
+    return job.result() if isinstance(job, Future) else job
+
+
+def job_ids(jobs: Iterable[Job]) -> list[str]:
+    identifiers = []
+
+    for job in jobs:
+        identifier = resolve(job)
+        identifiers.extend(identifier if isinstance(identifier, list) else [identifier])
+
+    return list(dict.fromkeys(identifiers))
+
+
+# sizes of the array jobs submitted by this driver
+array_sizes: dict[str, int] = {}
+
+# array jobs skipped whole by the cache, whose children stand for the same wait
+cached_arrays: set[Job] = set()
+
+
+def child(job: Job, index: int) -> Job:
+    "The child of an array job at the given index"
+
+    if isinstance(job, Node):
+        return Child(job, index)
+
+    if job in cached_arrays:
+        return job
+
+    if not isinstance(job, Future):
+        return f"{job}:{index}"
+
+    future = Future()
+
+    def done(parent: Future):
+        if parent.exception():
+            future.set_exception(parent.exception())
+        else:
+            future.set_result(f"{parent.result()}:{index}")
+
+    job.add_done_callback(done)
+    return future
+
+
+def collapse(identifiers: list[str]) -> list[str]:
+    "Depend on whole array jobs instead of on every one of their children"
+
+    children = {}
+
+    for identifier in identifiers:
+        parent, _, index = identifier.rpartition(":")
+        if parent in array_sizes:
+            children.setdefault(parent, set()).add(index)
+
+    complete = {
+        parent
+        for parent, indices in children.items()
+        if len(indices) == array_sizes[parent]
+    }
+
+    return list(
+        dict.fromkeys(
+            (
+                parent
+                if (parent := identifier.rpartition(":")[0]) in complete
+                else identifier
+            )
+            for identifier in identifiers
+        )
+    )
+
+
+def n_to_n_parent(identifiers: list) -> Optional[str]:
+    "The array job whose children are, in order, exactly the given job IDs"
+
+    if not all(isinstance(identifier, str) for identifier in identifiers):
+        return None
+
+    parents = {identifier.rpartition(":")[0] for identifier in identifiers}
+    indices = [identifier.rpartition(":")[2] for identifier in identifiers]
+
+    if len(parents) != 1:
+        return None
+
+    parent = parents.pop()
+
+    if array_sizes.get(parent) != len(identifiers):
+        return None
+
+    if indices != [str(index) for index in range(len(identifiers))]:
+        return None
+
+    return parent
+
+
+class DependencyFailed(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        "Take a token if one is available, otherwise return the time until there is one"
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.timestamp) * self.rate
+            )
+            self.timestamp = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while delay := self.try_acquire():
+            time.sleep(delay)
+
+
+# held jobs are only ever submitted by this process, so the driver has to stay alive
+# until every one of them is released; drain() at exit waits for that
+class Coordinator:
+    "Holds back jobs with more dependencies than Batch allows until enough of them have finished"
+
+    def __init__(self, client, interval: float = DEPENDENCY_POLL_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self.statuses: dict[str, str] = {}
+        self.waiting: list[tuple[list[str], Callable]] = []
+        self.lock = threading.Lock()
+        self.poller = None
+
+    def watch(self, dependencies: list[str], callback: Callable):
+        "Call back with the unfinished and the failed dependencies once few enough are unfinished, or with the error that kept them from being polled"
+
+        with self.lock:
+            self.waiting.append((dependencies, callback))
+
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.poll, daemon=True)
+                self.poller.start()
+
+    def poll(self):
+        errors = 0
+
+        while True:
+            time.sleep(self.interval)
+
+            with self.lock:
+                watched = {
+                    dependency
+                    for dependencies, _ in self.waiting
+                    for dependency in dependencies
+                    if self.statuses.get(dependency) not in ("SUCCEEDED", "FAILED")
+                }
+
+            try:
+                self.refresh(list(watched))
+            except Exception as error:
+                print(f"Could not describe jobs: {error}", file=sys.stderr)
+                errors += 1
+
+                if errors < DEPENDENCY_POLL_ATTEMPTS:
+                    continue
+
+                # without statuses the held jobs would never be released
+                with self.lock:
+                    waiting, self.waiting = self.waiting, []
+                    self.poller = None
+
+                for _, callback in waiting:
+                    callback([], [], error)
+
+                return
+
+            errors = 0
+            ready = []
+
+            with self.lock:
+                waiting, self.waiting = self.waiting, []
+
+                for dependencies, callback in waiting:
+                    unfinished = [
+                        dependency
+                        for dependency in dependencies
+                        if self.statuses.get(dependency) != "SUCCEEDED"
+                    ]
+                    failed = [
+                        dependency
+                        for dependency in dependencies
+                        if self.statuses.get(dependency) == "FAILED"
+                    ]
+
+                    if failed or len(unfinished) <= DEPENDENCY_LIMIT:
+                        ready.append((callback, unfinished, failed))
+                    else:
+                        self.waiting.append((dependencies, callback))
+
+            for callback, unfinished, failed in ready:
+                callback(unfinished, failed)
+
+    def refresh(self, jobs: list[str]):
+        for i in range(0, len(jobs), DESCRIBE_JOBS_LIMIT):
+            response = self.client.describe_jobs(jobs=jobs[i : i + DESCRIBE_JOBS_LIMIT])
+
+            for job in response["jobs"]:
+                self.statuses[job["jobId"]] = job["status"]
+
+
+class Submitter:
+    "Submits jobs to Batch from a bounded thread pool sharing one client and one rate limit"
+
+    def __init__(
+        self,
+        client=None,
+        rate: float = SUBMIT_JOB_RATE,
+        threads: int = SUBMISSION_THREADS,
+        retry_attempts: int = 8,
+        backoff: float = 0.5,
+        max_backoff: float = 20,
+    ):
+        self.client = client or boto3.client(
+            "batch", config=Config(max_pool_connections=threads)
+        )
+        self.bucket = TokenBucket(rate)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="Submitter")
+        self.coordinator = Coordinator(self.client)
+        self.retry_attempts = retry_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.futures: list[Future] = []
+
+    def execute(
+        self,
+        command: str,
+        job_name: str,
+        vcpu: int,
+        memory: int,
+        depends_on: list[Job],
+        retry_attempts: int,
+        job_queue: str,
+        environment: dict,
+    ) -> Future:
+        return self.submit(
+            jobName=job_name,
+            jobQueue=job_queue,
+            jobDefinition=os.environ["WORKER_JOB_DEFINITION_NAME"],
+            dependsOn=list(depends_on),
+            retryStrategy={"attempts": retry_attempts},
+            containerOverrides={
+                "command": ["worker", command],
+                "environment": [
+                    {"name": key, "value": str(value)}
+                    for key, value in environment.items()
+                ],
+                "resourceRequirements": [
+                    {"type": "MEMORY", "value": str(memory)},
+                    {"type": "VCPU", "value": str(vcpu)},
+                ],
+            },
+        )
+
+    def execute_array(
+        self,
+        commands: list[str],
+        job_name: str,
+        vcpu: int,
+        memory: int,
+        depends_on: list[Job],
+        each_depends_on: list[Job],
+        retry_attempts: int,
+        job_queue: str,
+        environment: dict,
+    ) -> Future:
+        if len(commands) > ARRAY_SIZE_LIMIT:
+            raise ValueError(f"Array jobs hold at most {ARRAY_SIZE_LIMIT} children")
+
+        # Batch requires array jobs to have at least two children
+        if len(commands) == 1:
+            commands = commands + [":"]
+
+        arrays_directory.mkdir(parents=True, exist_ok=True)
+
+        commands_file = arrays_directory / f"{job_name}-{uuid.uuid4()}.json"
+        commands_file.write_text(json.dumps(commands))
+
+        return self.submit(
+            jobName=job_name,
+            jobQueue=job_queue,
+            jobDefinition=os.environ["WORKER_JOB_DEFINITION_NAME"],
+            arrayProperties={"size": len(commands)},
+            dependsOn=list(depends_on),
+            eachDependsOn=list(each_depends_on),
+            retryStrategy={"attempts": retry_attempts},
+            containerOverrides={
+                "command": ["worker", "--array", str(commands_file)],
+                "environment": [
+                    {"name": key, "value": str(value)}
+                    for key, value in environment.items()
+                ],
+                "resourceRequirements": [
+                    {"type": "MEMORY", "value": str(memory)},
+                    {"type": "VCPU", "value": str(vcpu)},
+                ],
+            },
+        )
+
+    def wait(self, dependencies: list[Job]) -> Future:
+        "Stand for a set of jobs without launching a container"
+
+        future = Future()
+        self.after(dependencies, future, future.set_result)
+        return future
+
+    def submit(self, **parameters) -> Future:
+        future = Future()
+        self.futures.append(future)
+
+        depends_on = parameters.pop("dependsOn", [])
+        each_depends_on = parameters.pop("eachDependsOn", [])
+
+        self.after(
+            depends_on + each_depends_on,
+            future,
+            lambda _: self.schedule(
+                parameters, *self.dependencies(depends_on, each_depends_on), future
+            ),
+        )
+
+        return future
+
+    def dependencies(
+        self, depends_on: list[Job], each_depends_on: list[Job]
+    ) -> tuple[list[str], list[str]]:
+        "Split submitted dependencies into whole-job and N_TO_N ones"
+
+        dependencies = job_ids(depends_on)
+        n_to_n = []
+
+        if each_depends_on:
+            parent = n_to_n_parent([resolve(job) for job in each_depends_on])
+
+            if parent:
+                n_to_n.append(parent)
+            else:
+                dependencies += job_ids(each_depends_on)
+
+        return collapse(list(dict.fromkeys(dependencies))), n_to_n
+
+    def after(self, jobs: list[Job], future: Future, callback: Callable):
+        "Call back with the job IDs of jobs once all of them have been submitted"
+
+        pending = [job for job in jobs if isinstance(job, Future)]
+        remaining = [len(pending)]
+        lock = threading.Lock()
+
+        def proceed():
+            try:
+                dependencies = job_ids(jobs)
+            except Exception as error:
+                future.set_exception(DependencyFailed(error))
+            else:
+                callback(dependencies)
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            proceed()
+
+        if not pending:
+            return proceed()
+
+        for job in pending:
+            job.add_done_callback(done)
+
+    def schedule(
+        self,
+        parameters: dict,
+        dependencies: list[str],
+        n_to_n: list[str],
+        future: Future,
+    ):
+        if len(dependencies) + len(n_to_n) <= DEPENDENCY_LIMIT:
+            self.executor.submit(
+                self.submit_job, parameters, dependencies, n_to_n, future
+            )
+            return
+
+        def release(unfinished: list[str], failed: list[str], error: Exception = None):
+            if error is not None:
+                future.set_exception(DependencyFailed(error))
+            elif failed:
+                future.set_exception(DependencyFailed(*failed))
+            else:
+                self.executor.submit(
+                    self.submit_job, parameters, unfinished, n_to_n, future
+                )
+
+        self.coordinator.watch(dependencies, release)
+
+    def submit_job(
+        self,
+        parameters: dict,
+        dependencies: list[str],
+        n_to_n: list[str],
+        future: Future,
+    ):
+        parameters["dependsOn"] = [{"jobId": job_id} for job_id in dependencies] + [
+            {"jobId": job_id, "type": "N_TO_N"} for job_id in n_to_n
+        ]
+
+        for attempt in range(self.retry_attempts):
+            self.bucket.acquire()
+
+            try:
+                job_id = self.client.submit_job(**parameters)["jobId"]
+            except ClientError as error:
+                if (
+                    error.response["Error"]["Code"] not in THROTTLING_ERRORS
+                    or attempt == self.retry_attempts - 1
+                ):
+                    return future.set_exception(error)
+            except Exception as error:
+                return future.set_exception(error)
+            else:
+                if "arrayProperties" in parameters:
+                    array_sizes[job_id] = parameters["arrayProperties"]["size"]
+
+                return future.set_result(job_id)
+
+            time.sleep(
+                random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+            )
+
+    def drain(self):
+        for future in list(self.futures):
+            future.result()
+
+
+BACKENDS = {"batch": Submitter, "local": LocalScheduler}
+
+backend: Submitter | LocalScheduler = None
+
+# while a graph is set, jobs are recorded in it and only submitted by graph.run()
+graph: Graph = None
+
+# while a cache is set, steps given a version are skipped when found in it
+cache: Cache = None
+
+
+@atexit.register
+def drain():
+    if backend is None:
+        return
+
+    try:
+        backend.drain()
+    except Exception as error:
+        print(f"Job execution failed: {error!r}", file=sys.stderr)
+        os._exit(1)
+
+
+def select_backend() -> Submitter | LocalScheduler:
+    global backend
+
+    if backend is None:
+        backend = BACKENDS[os.environ.get("WORKER_BACKEND", "batch")]()
+
+    return backend
 
 
 def execute(
@@ -18,82 +535,243 @@ def execute(
     job_name: str,
     vcpu: int = 1,
     memory: int = 2048,
-    depends_on: list[str] = [],
+    depends_on: list[Job] = [],
+    retry_attempts: int = 1,
+    job_queue: str = os.environ.get("JOB_QUEUE_ARN"),
+    outputs: list[Path] = [],
+    inputs: list[str | Path] = [],
+    version: str = None,
+) -> Job:
+    if graph is not None:
+        return graph.add(
+            Node(
+                job_name,
+                command=command,
+                vcpu=vcpu,
+                memory=memory,
+                depends_on=list(depends_on),
+                retry_attempts=retry_attempts,
+                job_queue=job_queue,
+                outputs=list(outputs),
+                inputs=list(inputs),
+                version=version,
+            )
+        )
+
+    environment = {
+        "STDOUT_LOG": logs_directory / f"{job_name}.out",
+        "STDERR_LOG": logs_directory / f"{job_name}.err",
+        "JOB_NAME": job_name,
+        "REQUESTED_VCPU": vcpu,
+        "REQUESTED_MEMORY": memory,
+    }
+
+    logs_directory.mkdir(parents=True, exist_ok=True)
+
+    if cache is not None and version is not None:
+        step = describe_step(command, version, vcpu, memory, inputs, outputs)
+
+        # a step can only be skipped when everything upstream of it was as well
+        if all(dependency in cache.hits for dependency in depends_on) and cache.lookup(
+            step
+        ):
+            job = wait(depends_on)
+            cache.hits.add(job)
+            return job
+
+        environment["CACHE_STEP"] = json.dumps(
+            step | {"directory": str(cache.directory)}
+        )
+
+    return select_backend().execute(
+        command,
+        job_name,
+        vcpu,
+        memory,
+        list(depends_on),
+        retry_attempts,
+        job_queue,
+        environment,
+    )
+
+
+def execute_array(
+    commands: list[str],
+    job_name: str,
+    vcpu: int = 1,
+    memory: int = 2048,
+    depends_on: list[Job] = [],
+    each_depends_on: list[Job] = [],
     retry_attempts: int = 1,
-    job_queue: str = os.environ["JOB_QUEUE_ARN"],
-) -> str:
-    batch = boto3.client("batch")
+    job_queue: str = os.environ.get("JOB_QUEUE_ARN"),
+    outputs: list[list[Path]] = [],
+    inputs: list[list[str | Path]] = [],
+    version: str = None,
+) -> Job:
+    "Run each command as a child of one array job, child i depending on each_depends_on[i] and writing outputs[i] from inputs[i]"
+
+    if graph is not None:
+        return graph.add(
+            Node(
+                job_name,
+                commands=list(commands),
+                vcpu=vcpu,
+                memory=memory,
+                depends_on=list(depends_on),
+                each_depends_on=list(each_depends_on),
+                retry_attempts=retry_attempts,
+                job_queue=job_queue,
+                outputs=list(outputs),
+                inputs=list(inputs),
+                version=version,
+            )
+        )
 
     environment = {
         "STDOUT_LOG": logs_directory / f"{job_name}.out",
         "STDERR_LOG": logs_directory / f"{job_name}.err",
+        "JOB_NAME": job_name,
+        "REQUESTED_VCPU": vcpu,
+        "REQUESTED_MEMORY": memory,
     }
 
     logs_directory.mkdir(parents=True, exist_ok=True)
 
-    return batch.submit_job(
-        jobName=job_name,
-        jobQueue=job_queue,
-        jobDefinition=os.environ["WORKER_JOB_DEFINITION_NAME"],
-        dependsOn=[{"jobId": job_id} for job_id in depends_on],
-        retryStrategy={"attempts": retry_attempts},
-        containerOverrides={
-            "command": ["worker", command],
-            "environment": [
-                {"name": key, "value": str(value)} for key, value in environment.items()
-            ],
-            "resourceRequirements": [
-                {"type": "MEMORY", "value": str(memory)},
-                {"type": "VCPU", "value": str(vcpu)},
-            ],
-        },
-    )["jobId"]
+    commands = list(commands)
+
+    if cache is not None and version is not None:
+        upstream = all(dependency in cache.hits for dependency in depends_on)
+        steps = []
+
+        for index, command in enumerate(commands):
+            step = describe_step(
+                command,
+                version,
+                vcpu,
+                memory,
+                inputs[index] if inputs else [],
+                outputs[index] if outputs else [],
+            )
+
+            # a child found in the cache is left in the array as a no-op, keeping the indices of the others
+            if (
+                upstream
+                and all(
+                    dependency in cache.hits
+                    for dependency in each_depends_on[index : index + 1]
+                )
+                and cache.lookup(step)
+            ):
+                commands[index] = ":"
+                steps.append(None)
+            else:
+                steps.append(step | {"directory": str(cache.directory)})
+
+        if not any(steps):
+            job = wait(list(depends_on) + list(each_depends_on))
+            cached_arrays.add(job)
+            return job
 
+        arrays_directory.mkdir(parents=True, exist_ok=True)
 
-def wait(dependencies: Iterable[str] = []):
-    return execute(":", job_name="WAIT", depends_on=list(dependencies))
+        steps_file = arrays_directory / f"{job_name}-{uuid.uuid4()}.steps.json"
+        steps_file.write_text(json.dumps(steps))
+        environment["CACHE_STEPS"] = steps_file
 
+    return select_backend().execute_array(
+        commands,
+        job_name,
+        vcpu,
+        memory,
+        list(depends_on),
+        list(each_depends_on),
+        retry_attempts,
+        job_queue,
+        environment,
+    )
 
-def every(jobs: Iterable[str]):
-    "Shrink the dependency list to a list containing one job – used to go around the limit of 20 dependencies per job"
 
-    jobs_list = list(jobs)
+def wait(dependencies: Iterable[Job] = []):
+    if graph is not None:
+        return graph.add(Node("WAIT", depends_on=list(dependencies)))
 
-    if len(jobs_list) == 0:
-        return [wait()]
+    dependencies = list(dependencies)
+    job = select_backend().wait(dependencies)
 
-    if len(jobs_list) == 1:
-        return jobs_list
+    if cache is not None and all(
+        dependency in cache.hits for dependency in dependencies
+    ):
+        cache.hits.add(job)
 
-    reduced_jobs_list = [
-        wait(jobs_list[i : i + 20]) for i in range(0, len(jobs_list), 20)
-    ]
+    return job
 
-    return every(reduced_jobs_list)
+
+def every(jobs: Iterable[Job]):
+    "Shrink the dependency list to a list containing one job – the backend resolves dependency sets of any size"
+
+    return [wait(jobs)]
 
 
 def main():
-    command = sys.argv[1]
+    step = json.loads(os.environ.get("CACHE_STEP", "null"))
+
+    # each child of an array job has its own step, or none when it was found in the cache
+    if "CACHE_STEPS" in os.environ:
+        steps = json.loads(Path(os.environ["CACHE_STEPS"]).read_text())
+        index = int(os.environ["AWS_BATCH_JOB_ARRAY_INDEX"])
+        step = steps[index] if index < len(steps) else None
 
-    async def duplicate(stream, streams):
-        async for line in stream:
-            for target in streams:
-                target.write(line.decode())
+    # the key is taken from the inputs as they were when the step started
+    if step is not None:
+        step_cache = Cache(step["directory"])
+        key = step_cache.key(step)
+
+    if sys.argv[1] == "--array":
+        commands = json.loads(Path(sys.argv[2]).read_text())
+        command = commands[int(os.environ["AWS_BATCH_JOB_ARRAY_INDEX"])]
+    else:
+        command = sys.argv[1]
 
     async def execute(command):
         process = await asyncio.create_subprocess_shell(
             command,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
+            limit=CHUNK_SIZE,
         )
 
-        with open(os.environ["STDOUT_LOG"], "a") as stdout_log:
-            with open(os.environ["STDERR_LOG"], "a") as stderr_log:
+        monitor = Monitor(process.pid)
+        monitor.start()
+
+        with open_log(os.environ["STDOUT_LOG"]) as stdout_log:
+            with open_log(os.environ["STDERR_LOG"]) as stderr_log:
                 await asyncio.gather(
-                    duplicate(process.stdout, (sys.stdout, stdout_log)),
-                    duplicate(process.stderr, (sys.stderr, stderr_log)),
+                    tee(
+                        process.stdout,
+                        [
+                            LogTarget(stdout_log),
+                            LogTarget(sys.stdout.buffer, lossy=True),
+                        ],
+                    ),
+                    tee(
+                        process.stderr,
+                        [
+                            LogTarget(stderr_log),
+                            LogTarget(sys.stderr.buffer, lossy=True),
+                        ],
+                    ),
                 )
 
-        return await process.wait()
+        exit_code = await process.wait()
+
+        monitor.stop()
+        record(monitor, exit_code, os.environ["STDOUT_LOG"])
+
+        return exit_code
+
+    exit_code = asyncio.run(execute(command))
+
+    if step is not None and exit_code == 0 and key is not None:
+        step_cache.record(step, key)
 
-    return asyncio.run(execute(command))
+    return exit_code
@@ -0,0 +1,13 @@
+import os
+import sys
+
+from pathlib import Path
+
+# the worker's modules import each other from its source directory, and read where
+# the analysis is from the environment
+sys.path.insert(0, str(Path(__file__).parents[2] / "barrel" / "worker" / "src"))
+
+os.environ.setdefault("FILE_SYSTEM_MOUNT_POINT", "/tmp/barrel-tests")
+os.environ.setdefault("STUDY_NAME", "study")
+os.environ.setdefault("ANALYSIS_NAME", "analysis")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
@@ -0,0 +1,93 @@
+import pytest
+
+from bioinformatics.counts import Strandedness, count, matrix, write_counts
+from bioinformatics.genome import parse_gtf
+
+GTF = (
+    'chr1\tsrc\texon\t100\t200\t.\t+\t.\tgene_id "g1"; transcript_id "t1";\n'
+    'chr1\tsrc\texon\t150\t300\t.\t-\t.\tgene_id "g2"; transcript_id "t2";\n'
+    'chr1\tsrc\texon\t1000\t1100\t.\t+\t.\tgene_id "g3"; transcript_id "t3";\n'
+)
+
+
+def record(name, flag, position, cigar, length, hits=1):
+    fields = [
+        name,
+        flag,
+        "chr1",
+        position,
+        255,
+        cigar,
+        "*",
+        0,
+        0,
+        "A" * length,
+        "I" * length,
+    ]
+    return "\t".join(map(str, fields)) + f"\tNH:i:{hits}\n"
+
+
+SAM = "".join(
+    [
+        "@HD\tVN:1.4\n",
+        "@SQ\tSN:chr1\tLN:5000\n",
+        # across g1 and g2, which only strandedness tells apart
+        record("overlap", 0, 110, "50M", 50),
+        record("inside", 0, 1010, "20M", 20),
+        record("intergenic", 0, 500, "10M", 10),
+        record("unmapped", 4, 0, "*", 20),
+        record("multiple", 0, 1010, "20M", 20, hits=2),
+        # a block in g1 and a block in no gene count for g1
+        record("spliced", 0, 110, "10M800N10M", 20),
+        record("reverse", 16, 250, "20M", 20),
+        # a pair is counted once
+        record("pair", 99, 1020, "20M", 20),
+        record("pair", 147, 1050, "20M", 20),
+    ]
+)
+
+
+SPECIAL = ["__no_feature", "__ambiguous", "__not_aligned", "__alignment_not_unique"]
+
+
+@pytest.fixture
+def annotation(tmp_path):
+    gtf = tmp_path / "genes.gtf"
+    gtf.write_text(GTF)
+    return parse_gtf(gtf)
+
+
+@pytest.mark.parametrize(
+    "strandedness, genes, special",
+    [
+        (Strandedness.UNSTRANDED, [1, 1, 2], [1, 1, 1, 1]),
+        (Strandedness.FORWARD, [2, 1, 2], [1, 0, 1, 1]),
+        (Strandedness.REVERSE, [0, 1, 0], [5, 0, 1, 1]),
+    ],
+)
+def test_union_counts(tmp_path, annotation, strandedness, genes, special):
+    alignments = tmp_path / "alignments.sam"
+    alignments.write_text(SAM)
+
+    counter = count(alignments, annotation, strandedness)
+
+    assert counter.counts.tolist() == genes
+    assert counter.special == dict(zip(SPECIAL, special))
+
+
+def test_matrix(tmp_path, annotation):
+    alignments = tmp_path / "alignments.sam"
+    alignments.write_text(SAM)
+    counter = count(alignments, annotation, Strandedness.UNSTRANDED)
+
+    for name in ("a", "b"):
+        write_counts(tmp_path / f"{name}.tsv", name, annotation, counter)
+
+    matrix([tmp_path / "a.tsv", tmp_path / "b.tsv"], tmp_path / "counts.tsv")
+
+    assert (tmp_path / "counts.tsv").read_text().splitlines()[:4] == [
+        "gene\ta\tb",
+        "g1\t1\t1",
+        "g2\t1\t1",
+        "g3\t2\t2",
+    ]
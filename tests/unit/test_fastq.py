@@ -0,0 +1,88 @@
+import gzip
+import pytest
+
+from bioinformatics import fastq
+
+
+def records(count: int, length: int, mate: int) -> bytes:
+    return b"".join(
+        b"@read%d/%d\n%s\n+\n%s\n"
+        % (index, mate, b"ACGT"[index % 4 :][:1] * length, b"I" * length)
+        for index in range(count)
+    )
+
+
+def names(path) -> list[bytes]:
+    return [line.split(b"/")[0] for line in path.read_bytes().splitlines()[::4]]
+
+
+def test_split_fills_every_chunk_with_the_same_reads(tmp_path):
+    mates = [tmp_path / "reads_1.fastq", tmp_path / "reads_2.fastq.gz"]
+    mates[0].write_bytes(records(1000, 100, 1))
+    mates[1].write_bytes(gzip.compress(records(1000, 90, 2)))
+
+    chunks = fastq.chunk_files(mates, tmp_path / "chunks", 7)
+    (tmp_path / "chunks").mkdir()
+    fastq.split(mates, chunks)
+
+    assert [len(names(chunk)) for chunk in chunks[0]] == [143] * 6 + [142]
+
+    for first, second in zip(*chunks):
+        assert names(first) == names(second)
+
+    assert sorted(name for chunk in chunks[0] for name in names(chunk)) == sorted(
+        b"@read%d" % index for index in range(1000)
+    )
+
+
+def test_split_without_final_newline(tmp_path):
+    mate = tmp_path / "reads.fastq"
+    mate.write_bytes(b"@a\nAC\n+\nII\n@b\nGT\n+\nII")
+
+    chunks = fastq.chunk_files([mate], tmp_path, 2)
+    fastq.split([mate], chunks)
+
+    assert [chunk.read_bytes() for chunk in chunks[0]] == [
+        b"@a\nAC\n+\nII\n",
+        b"@b\nGT\n+\nII\n",
+    ]
+
+
+READS = b"@a\nACGN\n+\nII#I\n@b\nGGC\n+\n!!I\n@c\nACGN\n+\nIIII\n"
+
+
+def test_statistics_of_records():
+    statistics = fastq.Statistics()
+    statistics.update(READS)
+    summary = statistics.summary()
+
+    assert summary["reads"] == 3
+    assert summary["bases"] == 11
+    assert summary["length_histogram"] == {3: 1, 4: 2}
+    assert summary["gc_content"] == pytest.approx(100 * 7 / 9)
+    assert summary["n_content"] == pytest.approx(100 * 2 / 11)
+    assert summary["base_counts"]["G"] == [1, 1, 2, 0]
+    assert summary["mean_quality"][:3] == [
+        pytest.approx(80 / 3, abs=0.01),
+        pytest.approx(80 / 3, abs=0.01),
+        pytest.approx(82 / 3, abs=0.01),
+    ]
+
+
+def test_statistics_fed_in_any_pieces():
+    whole = fastq.Statistics()
+    whole.update(READS)
+
+    pieces = fastq.Statistics()
+    for start in range(0, len(READS), 5):
+        pieces.update(READS[start : start + 5])
+
+    assert pieces.summary() == whole.summary()
+
+
+def test_statistics_reject_other_records():
+    statistics = fastq.Statistics()
+    statistics.update(b">a\nACGT\n>b\nACGT\n")
+
+    with pytest.raises(ValueError):
+        statistics.summary()
@@ -0,0 +1,99 @@
+import pytest
+
+from bioinformatics.genome import (
+    GENE_INFO_COLUMNS,
+    Fasta,
+    index_fasta,
+    load_annotation,
+    parse_gtf,
+    write_gene_info,
+)
+
+
+def write(tmp_path, content: bytes):
+    fasta = tmp_path / "genome.fa"
+    fasta.write_bytes(content)
+    return fasta
+
+
+def test_index_matches_samtools(tmp_path):
+    fasta = write(tmp_path, b">c1 first\nACGTA\nCGTAC\nGT\n>c2\nAAAA\n")
+
+    # as written by samtools faidx
+    assert index_fasta(fasta).read_text() == "c1\t12\t10\t5\t6\nc2\t4\t29\t4\t5\n"
+
+
+def test_index_of_last_line_without_newline(tmp_path):
+    fasta = write(tmp_path, b">c1\nACGT\nAC\n>c2\nACGT\nA\n>c3\nTTT")
+
+    assert index_fasta(fasta).read_text().splitlines() == [
+        "c1\t6\t4\t4\t5",
+        "c2\t5\t16\t4\t5",
+        "c3\t3\t27\t3\t4",
+    ]
+    assert Fasta(fasta).fetch("c3", 0, 3) == "TTT"
+
+
+def test_index_of_crlf_lines(tmp_path):
+    fasta = write(tmp_path, b">c1\r\nACGT\r\nAC\r\n>c2\r\nGGG")
+
+    assert index_fasta(fasta).read_text().splitlines() == [
+        "c1\t6\t5\t4\t6",
+        "c2\t3\t20\t3\t5",
+    ]
+    assert Fasta(fasta).fetch("c1", 2, 6) == "GTAC"
+    assert Fasta(fasta).fetch("c2", 1, 3) == "GG"
+
+
+def test_lines_of_different_lengths(tmp_path):
+    fasta = write(tmp_path, b">c1\nACG\nACGT\n")
+
+    with pytest.raises(ValueError):
+        index_fasta(fasta)
+
+
+GTF = (
+    "#!genome-build test\n"
+    'chr1\tsrc\tgene\t100\t500\t.\t+\t.\tgene_id "g1"; gene_name "One"; gene_biotype "protein_coding";\n'
+    'chr1\tsrc\ttranscript\t100\t500\t.\t+\t.\tgene_id "g1"; transcript_id "t1";\n'
+    'chr1\tsrc\texon\t400\t500\t.\t+\t.\tgene_id "g1"; transcript_id "t1";\n'
+    'chr1\tsrc\texon\t100\t200\t.\t+\t.\tgene_id "g1"; transcript_id "t1";\n'
+    'chr1\tsrc\tCDS\t150\t200\t.\t+\t0\tgene_id "g1"; transcript_id "t1";\n'
+    'chr1\tsrc\texon\t150\t300\t.\t+\t.\tgene_id "g1"; transcript_id "t2";\n'
+    'chr2\tsrc\tgene\t10\t90\t.\t-\t.\tgene_id "g2"; gene_name "Two"; gene_type "lncRNA";\n'
+    'chr2\tsrc\texon\t10\t90\t.\t-\t.\tgene_id "g2"; transcript_id "t3";\n'
+)
+
+
+def test_gtf_columns(tmp_path):
+    gtf = tmp_path / "genes.gtf"
+    gtf.write_text(GTF)
+
+    annotation = parse_gtf(gtf)
+
+    assert annotation.feature.tolist() == [0, 1, 2, 2, 2, 0, 2]
+    assert annotation.start.tolist() == [99, 99, 399, 99, 149, 9, 9]
+    assert annotation.end.tolist() == [500, 500, 500, 200, 300, 90, 90]
+    assert annotation.strand.tolist() == [1, 1, 1, 1, 1, -1, -1]
+    assert annotation.transcript.tolist() == [-1, 0, 0, 0, 1, -1, 2]
+    assert annotation.genes.tolist() == ["g1", "g2"]
+    assert annotation.biotypes.tolist() == ["protein_coding", "lncRNA"]
+
+
+def test_gene_info(tmp_path):
+    gtf = tmp_path / "genes.gtf"
+    gtf.write_text(GTF)
+
+    output = tmp_path / "gene_info.txt"
+    write_gene_info(load_annotation(gtf), output)
+
+    assert output.read_text().splitlines() == [
+        "#" + "\t".join(GENE_INFO_COLUMNS),
+        "chr1\t+\t99\t500\t2\t99,399,\t200,500,\tt1\tg1\tOne\tprotein_coding",
+        "chr1\t+\t149\t300\t1\t149,\t300,\tt2\tg1\tOne\tprotein_coding",
+        "chr2\t-\t9\t90\t1\t9,\t90,\tt3\tg2\tTwo\tlncRNA",
+    ]
+
+    # loaded again from the columns cached next to the GTF file
+    assert (tmp_path / "genes.gtf.columns").is_dir()
+    assert load_annotation(gtf).genes.tolist() == ["g1", "g2"]
@@ -0,0 +1,104 @@
+import boto3
+import io
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from moto import mock_aws
+
+import transfer
+
+PART_SIZE = 5 * 2**20
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="bucket")
+        yield client
+
+
+def upload_in_parts(s3, key: str, content: bytes):
+    upload = s3.create_multipart_upload(Bucket="bucket", Key=key)
+    parts = []
+
+    for number, start in enumerate(range(0, len(content), PART_SIZE), 1):
+        part = s3.upload_part(
+            Bucket="bucket",
+            Key=key,
+            UploadId=upload["UploadId"],
+            PartNumber=number,
+            Body=content[start : start + PART_SIZE],
+        )
+        parts.append({"ETag": part["ETag"], "PartNumber": number})
+
+    s3.complete_multipart_upload(
+        Bucket="bucket",
+        Key=key,
+        UploadId=upload["UploadId"],
+        MultipartUpload={"Parts": parts},
+    )
+
+
+CONTENT = bytes(range(256)) * (12 * 2**20 // 256)
+
+
+def test_etag_of_object_uploaded_in_parts(s3, tmp_path):
+    upload_in_parts(s3, "object", CONTENT)
+    head = s3.head_object(Bucket="bucket", Key="object")
+
+    path = tmp_path / "object"
+    path.write_bytes(CONTENT)
+
+    part_size, parts = transfer.upload_parts(s3, "bucket", "object", head)
+    expected = head["ETag"].strip('"')
+
+    with ThreadPoolExecutor(4) as pool:
+        assert transfer.etag(path, len(CONTENT), part_size, parts, pool) == expected
+
+    streaming = transfer.StreamingETag(part_size, parts)
+    for start in range(0, len(CONTENT), 3 * 2**20):
+        streaming.update(CONTENT[start : start + 3 * 2**20])
+
+    assert streaming.hexdigest() == expected
+
+
+def test_verify_rejects_changed_content(s3, tmp_path):
+    s3.put_object(Bucket="bucket", Key="object", Body=b"ACGT" * 1000)
+    head = s3.head_object(Bucket="bucket", Key="object")
+
+    path = tmp_path / "object"
+
+    with ThreadPoolExecutor(2) as pool:
+        path.write_bytes(b"ACGT" * 1000)
+        transfer.verify(s3, "bucket", "object", head, path, pool)
+
+        path.write_bytes(b"ACGA" * 1000)
+        with pytest.raises(transfer.VerificationError):
+            transfer.verify(s3, "bucket", "object", head, path, pool)
+
+
+def test_download_and_stream_match_the_object(s3, tmp_path):
+    upload_in_parts(s3, "object", CONTENT)
+
+    destination = tmp_path / "object"
+    transfer.download(s3, "bucket", "object", destination, 4, 2**20)
+    assert destination.read_bytes() == CONTENT
+
+    output = io.BytesIO()
+    transfer.stream(s3, "bucket", "object", output, 4, 2**20)
+    assert output.getvalue() == CONTENT
+
+
+def test_statistics_never_fail_a_download(s3, tmp_path):
+    s3.put_object(Bucket="bucket", Key="reads.fastq", Body=b"\n@a\nACGT\n+\nIIII\n")
+
+    destination = tmp_path / "reads.fastq"
+    statistics = transfer.FastqStatistics(destination)
+    transfer.download(
+        s3, "bucket", "reads.fastq", destination, consume=statistics.update
+    )
+    statistics.record()
+
+    assert destination.read_bytes() == b"\n@a\nACGT\n+\nIIII\n"
+    assert not statistics.file.exists()